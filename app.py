@@ -1,15 +1,31 @@
+import base64
+import cProfile
+import csv
+import hashlib
+import importlib
+import json
 import os
-import pandas as pd
-from flask import Flask, render_template, request, redirect, send_file, jsonify, flash, url_for
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+import click
+from flask import Flask, Response, abort, g, has_request_context, render_template, request, redirect, send_file, jsonify, flash, url_for, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as SessionFlask
+from sqlalchemy import and_, case, event, func, inspect, or_
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import joinedload
 from flask_login import LoginManager, login_user, logout_user, login_required, UserMixin, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
-from datetime import datetime
-from io import BytesIO
-from xhtml2pdf import pisa
-from prophet import Prophet
+from datetime import datetime, timedelta
+from io import BytesIO, StringIO
+from tempfile import SpooledTemporaryFile
 
 load_dotenv()
 
@@ -17,10 +33,98 @@ app = Flask(__name__)
 app.secret_key = 'secret-finai'
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///database.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['UPLOAD_FOLDER'] = 'static/uploads'
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+app.config['DATABASE_READ_URL'] = os.getenv('DATABASE_READ_URL')  # réplique en lecture pour les routes d'analyse
+app.config['DB_POOL_SIZE'] = int(os.getenv('DB_POOL_SIZE', 10))  # connexions gardées ouvertes (PostgreSQL)
+app.config['DB_MAX_OVERFLOW'] = int(os.getenv('DB_MAX_OVERFLOW', 20))  # connexions en plus lors des pics
+app.config['DB_POOL_RECYCLE'] = int(os.getenv('DB_POOL_RECYCLE', 1800))  # secondes avant de renouveler une connexion
+app.config['SQLITE_WAL'] = os.getenv('SQLITE_WAL', '1') == '1'  # lectures non bloquées par une écriture en cours
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))  # attente sur un verrou
+app.config['SQLITE_SYNCHRONOUS'] = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')  # NORMAL suffit en WAL
+app.config['IMPORT_CHUNK_SIZE'] = int(os.getenv('IMPORT_CHUNK_SIZE', 10000))  # lignes par lot
+app.config['TRANSACTIONS_PAGE_SIZE'] = int(os.getenv('TRANSACTIONS_PAGE_SIZE', 50))  # lignes par page (défilement infini)
+app.config['EXPORT_CHUNK_SIZE'] = int(os.getenv('EXPORT_CHUNK_SIZE', 5000))  # lignes lues par aller-retour SQL
+app.config['EXPORT_SPOOL_SIZE'] = int(os.getenv('EXPORT_SPOOL_SIZE', 10 * 1024 * 1024))  # octets gardés en mémoire
+app.config['FORECAST_CACHE_SIZE'] = int(os.getenv('FORECAST_CACHE_SIZE', 256))
+app.config['FORECAST_CACHE_TTL'] = int(os.getenv('FORECAST_CACHE_TTL', 3600))  # secondes
+app.config['USER_CACHE_SIZE'] = int(os.getenv('USER_CACHE_SIZE', 1024))
+# Le cache est propre à chaque processus : promouvoir / destituer n'invalide que le processus qui traite la requête.
+# Ailleurs, l'ancien rôle reste en cache jusqu'à expiration, d'où une durée courte pour les administrateurs.
+app.config['USER_CACHE_TTL'] = int(os.getenv('USER_CACHE_TTL', 60))  # délai max pour voir un changement fait par un autre processus
+app.config['USER_CACHE_ADMIN_TTL'] = int(os.getenv('USER_CACHE_ADMIN_TTL', 5))  # idem pour un admin (droits retirés)
+app.config['FORECAST_WORKERS'] = int(os.getenv('FORECAST_WORKERS', 2))  # 0 = calcul synchrone
+app.config['FORECAST_MAX_HISTORY_DAYS'] = int(os.getenv('FORECAST_MAX_HISTORY_DAYS', 730))  # 0 = tout l'historique
+app.config['FORECAST_CUMUL'] = os.getenv('FORECAST_CUMUL', '0') == '1'  # prévoir le solde cumulé plutôt que le flux
+app.config['FORECAST_LATENCY_BUDGET_MS'] = int(os.getenv('FORECAST_LATENCY_BUDGET_MS', 5000))
+app.config['FORECAST_ENGINE'] = os.getenv('FORECAST_ENGINE')  # forcer un moteur (sinon choix automatique)
+app.config['FORECAST_MODEL_DIR'] = os.getenv('FORECAST_MODEL_DIR', os.path.join(app.instance_path, 'modeles'))  # modèles Prophet, états et résultats des calculs (partagé par les workers)
+app.config['FORECAST_MODEL_DIR_MB'] = int(os.getenv('FORECAST_MODEL_DIR_MB', 50))  # taille max des modèles Prophet, 0 = désactivé
+app.config['SIMULATION_PATHS'] = int(os.getenv('SIMULATION_PATHS', 10000))  # trajectoires Monte Carlo par simulation
+app.config['SIMULATION_HORIZON'] = int(os.getenv('SIMULATION_HORIZON', 90))  # jours simulés
+app.config['SIMULATION_HISTORY_DAYS'] = int(os.getenv('SIMULATION_HISTORY_DAYS', 365))  # historique rééchantillonné
+app.config['REPORT_WORKERS'] = int(os.getenv('REPORT_WORKERS', 2))  # rendus PDF simultanés, 0 = synchrone
+app.config['REPORT_DIR'] = os.getenv('REPORT_DIR', os.path.join(app.instance_path, 'rapports'))  # partagé par les processus web
+app.config['REPORT_DIR_MB'] = int(os.getenv('REPORT_DIR_MB', 500))  # taille max des PDF gardés, 0 = pas de limite
+app.config['CHART_MAX_POINTS'] = int(os.getenv('CHART_MAX_POINTS', 120))  # points d'historique tracés au maximum
+app.config['CHART_CACHE_SIZE'] = int(os.getenv('CHART_CACHE_SIZE', 128))  # images PNG gardées par processus
+app.config['METRICS_WINDOW'] = int(os.getenv('METRICS_WINDOW', 1000))  # dernières mesures gardées par route / span
+app.config['PROFILE_DIR'] = os.getenv('PROFILE_DIR')  # si défini, ?profile=1 enregistre un cProfile de la requête
+app.config['PRELOAD_MODULES'] = os.getenv('PRELOAD_MODULES', '')  # ex. "forecast,rapport" pour les pools préchauffés
+
+
+# ------------------ BASE DE DONNÉES ------------------
+def options_moteur(url):
+    # PostgreSQL : pool persistant, connexions vérifiées avant usage et renouvelées avant les coupures serveur
+    if make_url(url).get_backend_name() == 'postgresql':
+        return {
+            "pool_size": app.config['DB_POOL_SIZE'],
+            "max_overflow": app.config['DB_MAX_OVERFLOW'],
+            "pool_pre_ping": True,
+            "pool_recycle": app.config['DB_POOL_RECYCLE'],
+        }
+    return {}
+
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options_moteur(app.config['SQLALCHEMY_DATABASE_URI'])
+if app.config['DATABASE_READ_URL']:
+    app.config['SQLALCHEMY_BINDS'] = {
+        'lecture': dict(options_moteur(app.config['DATABASE_READ_URL']), url=app.config['DATABASE_READ_URL'])
+    }
+
 
-db = SQLAlchemy(app)
+@event.listens_for(Engine, 'connect')
+def _pragmas_sqlite(connexion, enregistrement):
+    # SQLite : réglages par connexion, appliqués à chaque ouverture par le pool
+    if not isinstance(connexion, sqlite3.Connection):
+        return
+    curseur = connexion.cursor()
+    if app.config['SQLITE_WAL']:
+        curseur.execute("PRAGMA journal_mode=WAL")
+    curseur.execute(f"PRAGMA busy_timeout={int(app.config['SQLITE_BUSY_TIMEOUT_MS'])}")
+    if app.config['SQLITE_SYNCHRONOUS'].upper() in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+        curseur.execute(f"PRAGMA synchronous={app.config['SQLITE_SYNCHRONOUS'].upper()}")
+    curseur.close()
+
+
+class SessionRoutee(SessionFlask):
+    # Dans une route @lecture_seule, les SELECT partent vers le moteur "lecture" s'il est configuré ;
+    # les écritures (flush) restent toujours sur la base principale
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_request_context() and g.get('lecture'):
+            lecture = self._db.engines.get('lecture')
+            if lecture is not None:
+                return lecture
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def lecture_seule(vue):
+    @wraps(vue)
+    def route(*args, **kwargs):
+        g.lecture = True
+        return vue(*args, **kwargs)
+    return route
+
+
+db = SQLAlchemy(app, session_options={"class_": SessionRoutee})
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
@@ -46,22 +150,68 @@ class User(db.Model, UserMixin):
 
 
 class Transaction(db.Model):
+    # Toutes les routes filtrent d'abord sur user_id, puis sur la date ou la catégorie
+    __table_args__ = (
+        db.Index('ix_transaction_user_date', 'user_id', 'date'),
+        db.Index('ix_transaction_user_category', 'user_id', 'category'),
+        db.Index('ix_transaction_user_empreinte', 'user_id', 'empreinte'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     date = db.Column(db.Date)
     category = db.Column(db.String(100))
     amount = db.Column(db.Float)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    # Contenu de la ligne importée (dédoublonnage). NULL pour une saisie manuelle faite après la migration ;
+    # les transactions antérieures, importées ou saisies, ont toutes une empreinte (voir remplir_empreintes)
+    empreinte = db.Column(db.String(32))
+
+class SoldeJournalier(db.Model):
+    # Agrégat maintenu à chaque écriture : flux d'un utilisateur pour un jour
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    jour = db.Column(db.Date, primary_key=True)
+    revenus = db.Column(db.Float, nullable=False, default=0)
+    depenses = db.Column(db.Float, nullable=False, default=0)  # négatives, comme les montants
+    nb = db.Column(db.Integer, nullable=False, default=0)
+
+class CategorieMensuelle(db.Model):
+    # Agrégat maintenu à chaque écriture : flux d'un utilisateur par catégorie et par mois
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    category = db.Column(db.String(100), primary_key=True)
+    mois = db.Column(db.Date, primary_key=True)  # 1er jour du mois
+    revenus = db.Column(db.Float, nullable=False, default=0)
+    depenses = db.Column(db.Float, nullable=False, default=0)
+    nb = db.Column(db.Integer, nullable=False, default=0)
+
+class PrevisionCalculee(db.Model):
+    # Prévision précalculée (sans filtre de dates), valable tant que l'empreinte des données est la même
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    empreinte = db.Column(db.String(100), nullable=False)
+    moteur = db.Column(db.String(30))
+    resultat = db.Column(db.Text, nullable=False)  # JSON : historique, prevision, alerte
+    date_calcul = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Alerte(db.Model):
+    # Alertes calculées à l'écriture et lues telles quelles par les tableaux de bord
+    __table_args__ = (
+        db.Index('ux_alerte_user_cle', 'user_id', 'cle', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     message = db.Column(db.String(300))
     date = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    cle = db.Column(db.String(60))  # "solde" ou "budget:<id>:<début de période>"
+    budget_id = db.Column(db.Integer, db.ForeignKey('budget.id'))
+    debut = db.Column(db.Date)  # période concernée (vide pour le solde)
+    fin = db.Column(db.Date)
+    montant = db.Column(db.Float)
 
 class Budget(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     category = db.Column(db.String(100), nullable=False)
     montant_max = db.Column(db.Float, nullable=False)
+    periode = db.Column(db.String(10), nullable=False, default='mensuel', server_default='mensuel')  # ou "annuel"
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
 
@@ -70,7 +220,137 @@ class Budget(db.Model):
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Cache par processus : l'utilisateur est chargé une fois avec son entreprise et son admin,
+    # puis détaché de la session pour servir aux requêtes suivantes sans toucher la table user
+    cle = (int(user_id),)
+    user = user_cache.get(cle)
+    if user is None:
+        user = db.session.get(User, cle[0], options=[joinedload(User.entreprise), joinedload(User.admin)])
+        if user is not None:
+            for objet in (user, user.entreprise, user.admin):
+                if objet is not None:
+                    db.session.expunge(objet)
+            user_cache.set(cle, user, ttl=app.config['USER_CACHE_ADMIN_TTL'] if user.is_admin else None)
+    return user
+
+# ------------------ INSTRUMENTATION ------------------
+class Metriques:
+    # Fenêtre glissante des dernières mesures (durée, requêtes SQL, temps SQL) par route ou par span
+    def __init__(self, taille=1000):
+        self.taille = taille
+        self._mesures = {}
+        self._totaux = Counter()
+        self._lock = threading.Lock()
+        self.depuis = time.time()
+
+    def ajouter(self, nom, duree_ms, sql=0, sql_ms=0.0):
+        with self._lock:
+            self._mesures.setdefault(nom, deque(maxlen=self.taille)).append((duree_ms, sql, sql_ms))
+            self._totaux[nom] += 1
+
+    def resume(self):
+        with self._lock:
+            mesures = {nom: list(valeurs) for nom, valeurs in self._mesures.items()}
+            totaux = dict(self._totaux)
+        resume = {}
+        for nom, valeurs in sorted(mesures.items()):
+            durees = sorted(v[0] for v in valeurs)
+            centile = lambda q: round(durees[min(len(durees) - 1, int(q * len(durees)))], 2)
+            resume[nom] = {
+                "total": totaux[nom],
+                "fenetre": len(valeurs),
+                "p50_ms": centile(0.50),
+                "p95_ms": centile(0.95),
+                "p99_ms": centile(0.99),
+                "max_ms": round(durees[-1], 2),
+                "sql_moyen": round(sum(v[1] for v in valeurs) / len(valeurs), 1),
+                "sql_ms_moyen": round(sum(v[2] for v in valeurs) / len(valeurs), 2),
+            }
+        return resume
+
+
+metriques = Metriques(app.config['METRICS_WINDOW'])
+_spans_locaux = threading.local()
+
+
+def enregistrer_span(nom, duree_ms):
+    # Dans un worker (_avec_spans), le span est renvoyé avec le résultat plutôt que perdu dans le worker
+    collecte = getattr(_spans_locaux, 'collecte', None)
+    if collecte is not None:
+        collecte.append((nom, duree_ms))
+    else:
+        metriques.ajouter(f"span {nom}", duree_ms)
+
+
+@contextmanager
+def span(nom):
+    debut = time.perf_counter()
+    try:
+        yield
+    finally:
+        enregistrer_span(nom, (time.perf_counter() - debut) * 1000)
+
+
+def _avec_spans(fonction, *args, **kwargs):
+    # Enveloppe des tâches de pool : renvoie (résultat, spans mesurés pendant la tâche)
+    precedente, _spans_locaux.collecte = getattr(_spans_locaux, 'collecte', None), []
+    try:
+        return fonction(*args, **kwargs), _spans_locaux.collecte
+    finally:
+        _spans_locaux.collecte = precedente
+
+
+def fusionner_spans(spans):
+    for nom, duree_ms in spans:
+        enregistrer_span(nom, duree_ms)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _debut_requete_sql(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('debuts_sql', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _fin_requete_sql(conn, cursor, statement, parameters, context, executemany):
+    duree = (time.perf_counter() - conn.info['debuts_sql'].pop()) * 1000
+    mesure = g.get('mesure') if has_request_context() else None
+    if mesure is not None:
+        mesure["sql"] += 1
+        mesure["sql_ms"] += duree
+
+
+@app.before_request
+def debut_mesure():
+    g.mesure = {"debut": time.perf_counter(), "sql": 0, "sql_ms": 0.0}
+    if app.config['PROFILE_DIR'] and request.args.get('profile') == '1':
+        g.profil = cProfile.Profile()
+        g.profil.enable()
+
+
+@app.after_request
+def entete_profil(response):
+    if g.get('profil') is not None:
+        g.fichier_profil = f"{time.strftime('%Y%m%d-%H%M%S')}-{request.endpoint}-{uuid.uuid4().hex[:8]}.prof"
+        response.headers['X-Profile'] = g.fichier_profil
+    return response
+
+
+@app.teardown_request
+def fin_mesure(exc):
+    # teardown : après l'envoi complet de la réponse, y compris les exports en streaming
+    mesure = g.pop('mesure', None)
+    if mesure is None:
+        return
+    duree = (time.perf_counter() - mesure["debut"]) * 1000
+    route = request.url_rule.rule if request.url_rule else "(404)"
+    metriques.ajouter(f"{request.method} {route}", duree, mesure["sql"], mesure["sql_ms"])
+
+    profil = g.pop('profil', None)
+    if profil is not None:
+        profil.disable()
+        os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+        profil.dump_stats(os.path.join(app.config['PROFILE_DIR'], g.get('fichier_profil', 'requete.prof')))
+
 
 # ------------------ ROUTES ------------------
 
@@ -81,11 +361,8 @@ def splash():
 @app.route('/home')
 @login_required
 def home():
-    # Récupérer toutes les transactions de l’utilisateur
-    txs = Transaction.query.filter_by(user_id=current_user.id).order_by(Transaction.date).all()
-
     # Alertes IA existantes + budget
-    alerts = generate_alerts(txs)
+    alerts = generate_alerts(current_user.id)
 
     return render_template('dashboard.html', user=current_user, alerts=alerts)
 
@@ -170,36 +447,35 @@ def transactions():
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
 
-    query = Transaction.query.filter_by(user_id=current_user.id)
+    criteres = criteres_transactions(current_user.id, start_date, end_date)
 
     if selected:
-        query = query.filter_by(category=selected)
-
-    # ✅ Période dynamique
-    if start_date:
-        query = query.filter(Transaction.date >= start_date)
-    if end_date:
-        query = query.filter(Transaction.date <= end_date)
+        criteres.append(Transaction.category == selected)
 
     # Optionnel : filtres fixes en plus
+    aujourd_hui = datetime.utcnow().date()
     if periode == 'mois':
-        query = query.filter(Transaction.date >= date.today().replace(day=1))
+        criteres.append(Transaction.date >= aujourd_hui.replace(day=1))
     elif periode == 'semaine':
-        start_of_week = date.today() - timedelta(days=date.today().weekday())
-        query = query.filter(Transaction.date >= start_of_week)
+        criteres.append(Transaction.date >= aujourd_hui - timedelta(days=aujourd_hui.weekday()))
 
-    txs = query.order_by(Transaction.date).all()
-    total = sum(t.amount for t in txs)
-    alerts = generate_alerts(txs)
-    categories = list({t.category for t in Transaction.query.filter_by(user_id=current_user.id).all()})
+    # Une page à la fois ; les suivantes sont chargées en JSON au défilement (?format=json&apres=<curseur>)
+    txs, suivant = page_transactions(criteres, request.args.get('apres'))
+    if request.args.get('format') == 'json':
+        return page_json(txs, suivant)
+
+    totaux = totaux_transactions(*criteres)
+    alerts = generate_alerts(current_user.id, start_date, end_date)
     return render_template(
         'transactions.html',
         transactions=txs,
+        suivant=suivant,
         alerts=alerts,
-        categories=categories,
+        categories=categories_utilisateur(current_user.id),
         selected=selected,
         periode=periode,
-        total=total,
+        nb_transactions=totaux.nb,
+        total=round(totaux.revenus + totaux.depenses, 2),
         start_date=start_date,
         end_date=end_date
     )
@@ -214,7 +490,11 @@ def add():
         user_id=current_user.id
     )
     db.session.add(tx)
+    maj_agregats(apres=[tx])
+    evaluer_alertes(current_user.id, {tx.category})
+    invalider_prevision(current_user.id)
     db.session.commit()
+    forecast_cache.invalidate_user(current_user.id)
     flash("Transaction ajoutée")
     return redirect('/transactions')
 
@@ -223,10 +503,15 @@ def add():
 def update():
     tx = Transaction.query.get(request.form['id'])
     if tx and tx.user_id == current_user.id:
+        avant = lignes_agregats([tx])
         tx.date = datetime.strptime(request.form['date'], '%Y-%m-%d').date()
         tx.category = request.form['category']
-        tx.amount = request.form['amount']
+        tx.amount = float(request.form['amount'])
+        maj_agregats(avant=avant, apres=[tx])
+        evaluer_alertes(current_user.id, {avant[0][2], tx.category})
+        invalider_prevision(current_user.id)
         db.session.commit()
+        forecast_cache.invalidate_user(current_user.id)
         flash("Transaction mise à jour")
     return redirect('/transactions')
 
@@ -236,7 +521,11 @@ def delete():
     tx = Transaction.query.get(request.form['id'])
     if tx and tx.user_id == current_user.id:
         db.session.delete(tx)
+        maj_agregats(avant=[tx])
+        evaluer_alertes(current_user.id, {tx.category})
+        invalider_prevision(current_user.id)
         db.session.commit()
+        forecast_cache.invalidate_user(current_user.id)
         flash("Transaction supprimée")
     return redirect('/transactions')
 
@@ -244,53 +533,96 @@ def delete():
 @login_required
 def import_csv():
     file = request.files['file']
-    if file.filename.endswith('.csv'):
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(file.filename))
-        file.save(filepath)
-        df = pd.read_csv(filepath)
-        for _, row in df.iterrows():
-            tx = Transaction(
-                date=pd.to_datetime(row['date']).date(),
-                category=row['category'],
-                amount=row['amount'],
-                user_id=current_user.id
-            )
-            db.session.add(tx)
+    if file.filename.lower().endswith(('.csv', '.csv.gz')):
+        # Lecture directe du flux envoyé : aucun fichier écrit dans static/uploads
+        stream = file.stream
+        compression = 'gzip' if stream.read(2) == GZIP_MAGIC else None
+        stream.seek(0)
+        try:
+            stats = import_transactions_csv(stream, current_user.id, compression=compression)
+        except (ValueError, OSError, EOFError) as e:
+            db.session.rollback()
+            flash(f"Import impossible : {e}")
+            stats = None
+        # Une seule évaluation pour tout le fichier, sur les catégories importées ;
+        # si l'import s'est arrêté en route, les paquets déjà validés comptent : on réévalue tout
+        evaluer_alertes(current_user.id, stats["categories"] if stats is not None else None)
+        invalider_prevision(current_user.id)
         db.session.commit()
-        flash("Transactions importées")
+        forecast_cache.invalidate_user(current_user.id)
+        if stats is not None:
+            flash(format_import_stats(stats))
     return redirect('/transactions')
 
 # ------------------ EXPORT ------------------
 
+def lignes_export(user_id):
+    # Lecture par paquets (yield_per) : seules EXPORT_CHUNK_SIZE lignes sont en mémoire à la fois
+    criteres = criteres_transactions(user_id, request.args.get('start_date'), request.args.get('end_date'))
+    if request.args.get('category'):
+        criteres.append(Transaction.category == request.args['category'])
+    stmt = db.select(Transaction.date, Transaction.category, Transaction.amount) \
+        .where(*criteres).order_by(Transaction.date, Transaction.id) \
+        .execution_options(yield_per=app.config['EXPORT_CHUNK_SIZE'])
+    return db.session.execute(stmt).partitions()
+
+
+@app.route('/export/csv')
+@login_required
+def export_csv():
+    paquets = lignes_export(current_user.id)
+
+    def generer():
+        # Même format que l'import : un export CSV peut être réimporté tel quel
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(IMPORT_COLONNES)
+        for paquet in paquets:
+            writer.writerows(paquet)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    return Response(stream_with_context(generer()), mimetype='text/csv',
+                    headers={"Content-Disposition": "attachment; filename=transactions.csv"})
+
+
 @app.route('/export/excel')
 @login_required
 def export_excel():
-    txs = Transaction.query.filter_by(user_id=current_user.id).all()
-    df = pd.DataFrame([(t.date, t.category, t.amount) for t in txs], columns=['Date', 'Catégorie', 'Montant'])
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False)
+    from openpyxl import Workbook
+
+    # Classeur en écriture seule alimenté par paquets, enregistré dans un fichier temporaire
+    # qui ne passe sur disque qu'au-delà d'EXPORT_SPOOL_SIZE
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Transactions')
+    ws.append(['Date', 'Catégorie', 'Montant'])
+    for paquet in lignes_export(current_user.id):
+        for ligne in paquet:
+            ws.append(tuple(ligne))
+
+    output = SpooledTemporaryFile(max_size=app.config['EXPORT_SPOOL_SIZE'])
+    wb.save(output)
     output.seek(0)
-    return send_file(output, as_attachment=True, download_name="transactions.xlsx")
+    return send_file(output, as_attachment=True, download_name="transactions.xlsx",
+                     mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
 @app.route('/export/pdf')
 @login_required
 def export_pdf():
-    txs = Transaction.query.filter_by(user_id=current_user.id).all()
-    html = render_template('pdf_template.html', transactions=txs)
-    output = BytesIO()
-    pisa.CreatePDF(html, dest=output)
-    output.seek(0)
-    return send_file(output, as_attachment=True, download_name="transactions.pdf")
+    # Les transactions sont lues par le worker de rendu : la requête ne charge rien
+    job_id = report_jobs.submit('pdf_template.html', {}, user_id=current_user.id, nom="transactions.pdf",
+                                transactions_de=current_user.id)
+    return reponse_rapport(job_id)
 
 # ------------------ PRÉVISION IA ------------------
-def generer_conseil(transactions, prevision):
-    if not transactions:
+def generer_conseil(totaux, prevision):
+    if not totaux.nb:
         return "Ajoutez quelques transactions pour que FinAI puisse vous conseiller intelligemment."
 
-    total_revenus = sum(t.amount for t in transactions if t.amount > 0)
-    total_depenses = sum(t.amount for t in transactions if t.amount < 0)
-    total_depenses_abs = abs(total_depenses)
+    total_revenus = totaux.revenus
+    total_depenses_abs = abs(totaux.depenses)
 
     prevision_negative = any(p['value'] < 0 for p in prevision)
 
@@ -307,21 +639,33 @@ def generer_conseil(transactions, prevision):
 
 @app.route('/forecast')
 @login_required
+@lecture_seule
 def forecast():
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
 
-    query = Transaction.query.filter_by(user_id=current_user.id)
-    if start_date:
-        query = query.filter(Transaction.date >= start_date)
-    if end_date:
-        query = query.filter(Transaction.date <= end_date)
-
-    txs = query.order_by(Transaction.date).all()
-    forecast_data = generate_forecast(txs)
-
-    total_revenus = sum(t.amount for t in txs if t.amount >= 0)
-    total_depenses = abs(sum(t.amount for t in txs if t.amount < 0))
+    # Flux journaliers pré-agrégés : O(jours) lignes au lieu d'O(transactions)
+    rows = flux_journaliers(current_user.id, start_date, end_date)
+
+    # La prévision est calculée en arrière-plan : on affiche le cache ou le dernier résultat connu
+    forecast_data = {'historique': [], 'prevision': [], 'alerte': False}
+    job_id = None
+    if rows:
+        fenetre = (start_date, end_date)
+        key = forecast_key(current_user.id, fenetre, rows)
+        cached = prevision_disponible(key)
+        if cached is not None:
+            forecast_data = cached
+        else:
+            job_id = forecast_jobs.submit(key, rows)
+            if forecast_jobs.status(job_id)["status"] == "done":
+                forecast_data, job_id = forecast_cache.get(key) or forecast_data, None
+            else:
+                forecast_data = forecast_jobs.derniers.get((current_user.id, fenetre)) or forecast_data
+
+    totaux = totaux_transactions(*criteres_transactions(current_user.id, start_date, end_date))
+    total_revenus = totaux.revenus
+    total_depenses = abs(totaux.depenses)
     solde_prevu = forecast_data["prevision"][-1]["value"] if forecast_data["prevision"] else 0
 
     if len(forecast_data["prevision"]) >= 2:
@@ -331,15 +675,26 @@ def forecast():
     else:
         tendance = "stable"
 
-    score = solde_prevu + total_revenus - total_depenses
-    if score >= 1000:
-        sante = {"label": "Saine 🟢", "class": "bg-green-100 text-green-800"}
-    elif score >= 0:
-        sante = {"label": "Fragile 🟡", "class": "bg-yellow-100 text-yellow-800"}
+    # Scénarios : simulation Monte Carlo calculée dans la requête, avec une éventuelle réduction d'une catégorie
+    categorie_scenario = request.args.get('categorie_scenario') or None
+    reduction = request.args.get('reduction', 0, type=float)
+    ajustements = {categorie_scenario: 1 - reduction / 100} if categorie_scenario and reduction else None
+    simulation = simulation_tresorerie(current_user.id, start_date, end_date, ajustements) if rows else None
+
+    if simulation is not None:
+        # Santé = risque de découvert sur l'horizon simulé
+        risque = simulation["proba_decouvert"]
+        niveau = 0 if risque < 0.05 else 1 if risque < 0.25 else 2
     else:
-        sante = {"label": "Critique 🔴", "class": "bg-red-100 text-red-800"}
+        score = solde_prevu + total_revenus - total_depenses
+        niveau = 0 if score >= 1000 else 1 if score >= 0 else 2
+    sante = (
+        {"label": "Saine 🟢", "class": "bg-green-100 text-green-800"},
+        {"label": "Fragile 🟡", "class": "bg-yellow-100 text-yellow-800"},
+        {"label": "Critique 🔴", "class": "bg-red-100 text-red-800"},
+    )[niveau]
 
-    conseil = generer_conseil(txs, forecast_data["prevision"])
+    conseil = generer_conseil(totaux, forecast_data["prevision"])
 
     return render_template('forecast.html',
         historique=forecast_data["historique"],
@@ -352,7 +707,13 @@ def forecast():
         sante=sante,
         conseil=conseil,
         start_date=start_date,
-        end_date=end_date
+        end_date=end_date,
+        job_id=job_id,
+        moteur=forecast_data.get("moteur"),
+        simulation=simulation,
+        categories=categories_utilisateur(current_user.id) if simulation else [],
+        categorie_scenario=categorie_scenario,
+        reduction=reduction
     )
 # ------------------ BUDGETS ------------------
 @app.route('/budgets', methods=['GET', 'POST'])
@@ -361,48 +722,41 @@ def budgets():
     if request.method == 'POST':
         new_budget = Budget(
             category=request.form['category'],
-            montant_max=request.form['montant_max'],
+            montant_max=float(request.form['montant_max']),
+            periode=request.form.get('periode') if request.form.get('periode') in PERIODES_BUDGET else 'mensuel',
             user_id=current_user.id
         )
         db.session.add(new_budget)
+        db.session.flush()
+        evaluer_alertes(current_user.id, {new_budget.category})
         db.session.commit()
         flash("Budget ajouté avec succès.")
         return redirect('/budgets')
     
     budgets = Budget.query.filter_by(user_id=current_user.id).all()
-    return render_template('budgets.html', budgets=budgets)
+    return render_template('budgets.html', budgets=budgets, periodes=PERIODES_BUDGET)
 
 @app.route('/categories')
 @login_required
+@lecture_seule
 def analyse_categories():
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
 
-    txs = Transaction.query.filter_by(user_id=current_user.id).all()
-
-    # Filtrage par date
-    if start_date and end_date:
-        start = datetime.strptime(start_date, '%Y-%m-%d').date()
-        end = datetime.strptime(end_date, '%Y-%m-%d').date()
-        txs = [t for t in txs if start <= t.date <= end]
-
-    # Dépenses uniquement
-    depenses = [t for t in txs if t.amount < 0]
-
-    categorie_totaux = {}
-    for t in depenses:
-        if t.category in categorie_totaux:
-            categorie_totaux[t.category] += abs(t.amount)
-        else:
-            categorie_totaux[t.category] = abs(t.amount)
+    # Filtrage par date (appliqué seulement si les deux bornes sont fournies)
+    if not (start_date and end_date):
+        start_date = end_date = None
 
+    # Dépenses uniquement, lues dans les agrégats par catégorie
+    categorie_totaux = {
+        category: abs(depenses)
+        for category, revenus, depenses in totaux_categories(current_user.id, start_date, end_date)
+        if depenses < 0
+    }
     categorie_totaux = dict(sorted(categorie_totaux.items(), key=lambda x: x[1], reverse=True))
 
     return render_template('categories.html', data=categorie_totaux,
-                           start_date=start_date, end_date=end_date)
-from flask import make_response
-import matplotlib.pyplot as plt
-import base64
+                           start_date=request.args.get('start_date'), end_date=request.args.get('end_date'))
 # ------------------ RAPPORTS ------------------
 @app.route('/rapport')
 @login_required
@@ -410,54 +764,26 @@ def rapport_pdf():
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
 
-    # Récupérer transactions de l'utilisateur
-    txs = Transaction.query.filter_by(user_id=current_user.id).all()
-    if start_date and end_date:
-        start = datetime.strptime(start_date, '%Y-%m-%d').date()
-        end = datetime.strptime(end_date, '%Y-%m-%d').date()
-        txs = [t for t in txs if start <= t.date <= end]
-
-    total_revenus = sum(t.amount for t in txs if t.amount > 0)
-    total_depenses = sum(abs(t.amount) for t in txs if t.amount < 0)
-    forecast_data = generate_forecast(txs)
-    conseil = generer_conseil(txs, forecast_data["prevision"])
-    alerts = generate_alerts(txs)
-
-    # ✅ Générer une image de prévision
-    plt.figure(figsize=(10, 4))
-    historique = [t.amount for t in txs]
-    labels = [t.date.strftime('%d/%m') for t in txs]
-    plt.plot(labels, historique, label='Historique')
-    plt.plot([p['day'] for p in forecast_data['prevision']],
-             [p['value'] for p in forecast_data['prevision']], linestyle='--', label='Prévision')
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.legend()
-
-    # Encode image to base64
-    buf = BytesIO()
-    plt.savefig(buf, format='png')
-    buf.seek(0)
-    image_base64 = base64.b64encode(buf.read()).decode('utf-8')
-    plt.close()
-
-    html = render_template('rapport_template.html',
-                           user=current_user,
-                           total_revenus=total_revenus,
-                           total_depenses=total_depenses,
-                           forecast=forecast_data['prevision'],
-                           alerts=alerts,
-                           conseil=conseil,
-                           start=start_date,
-                           end=end_date,
-                           chart=image_base64)
-
-    output = BytesIO()
-    pisa.CreatePDF(html, dest=output)
-    output.seek(0)
-
-    return send_file(output, as_attachment=True,
-                     download_name="rapport_mensuel.pdf", mimetype="application/pdf")
+    # Fenêtre appliquée seulement si les deux bornes sont fournies
+    if not (start_date and end_date):
+        start_date = end_date = None
+
+    # Seules les données sont lues ici ; prévision, graphique et PDF sont produits par un worker
+    totaux = totaux_transactions(*criteres_transactions(current_user.id, start_date, end_date))
+    rows = flux_journaliers(current_user.id, start_date, end_date)
+    contexte = {
+        "user": {"email": current_user.email},
+        "totaux": list(totaux),
+        "total_revenus": totaux.revenus,
+        "total_depenses": abs(totaux.depenses),
+        "alerts": generate_alerts(current_user.id, start_date, end_date),
+        "start": start_date,
+        "end": end_date
+    }
+    prevision = prevision_disponible(forecast_key(current_user.id, (start_date, end_date), rows)) if rows else None
+    job_id = report_jobs.submit('rapport_template.html', contexte, user_id=current_user.id,
+                                nom="rapport_mensuel.pdf", forecast_rows=rows, prevision=prevision)
+    return reponse_rapport(job_id)
 
 
 # ----------------------
@@ -466,6 +792,7 @@ def rapport_pdf():
 
 @app.route('/admin/utilisateurs')
 @login_required
+@lecture_seule
 def admin_utilisateurs():
     if not current_user.is_admin:
         flash("Accès réservé à l’administrateur.")
@@ -479,22 +806,22 @@ def admin_utilisateurs():
     if search_email:
         query = query.filter(User.email.ilike(f"%{search_email}%"))
 
-    utilisateurs_pagines = query.paginate(page=page, per_page=per_page)
+    # La page d'utilisateurs d'abord, puis une seule requête groupée limitée à ses utilisateurs
+    utilisateurs_pagines = query.order_by(User.id).paginate(page=page, per_page=per_page)
+    stats = totaux_par_utilisateur([u.id for u in utilisateurs_pagines.items])
 
     data_utilisateurs = []
     for utilisateur in utilisateurs_pagines.items:
-        txs = Transaction.query.filter_by(user_id=utilisateur.id).all()
-        total_depenses = round(sum(t.amount for t in txs if t.amount < 0), 2)
-        total_revenus = round(sum(t.amount for t in txs if t.amount > 0), 2)
+        nb, revenus, depenses = stats.get(utilisateur.id, (0, 0, 0))
         data_utilisateurs.append({
             "id": utilisateur.id,
             "email": utilisateur.email,
             "role": utilisateur.role,
             "date_creation": utilisateur.date_creation,
             "last_login": utilisateur.last_login,
-            "nb_transactions": len(txs),
-            "depenses": total_depenses,
-            "revenus": total_revenus,
+            "nb_transactions": nb,
+            "depenses": round(depenses, 2),
+            "revenus": round(revenus, 2),
             "is_admin": utilisateur.is_admin
         })
 
@@ -512,6 +839,7 @@ def admin_utilisateurs():
 
 @app.route('/admin/utilisateur/<int:user_id>/transactions')
 @login_required
+@lecture_seule
 def admin_utilisateur_transactions(user_id):
     if not current_user.is_admin:
         return redirect('/home')
@@ -523,25 +851,21 @@ def admin_utilisateur_transactions(user_id):
     end_date = request.args.get('end_date')
     category = request.args.get('category')
 
-    query = Transaction.query.filter_by(user_id=user_id)
-
-    if start_date:
-        query = query.filter(Transaction.date >= start_date)
-    if end_date:
-        query = query.filter(Transaction.date <= end_date)
+    criteres = criteres_transactions(user_id, start_date, end_date)
     if category:
-        query = query.filter(Transaction.category.ilike(f"%{category}%"))
+        criteres.append(Transaction.category.ilike(f"%{category}%"))
 
-    transactions = query.order_by(Transaction.date.desc()).all()
+    transactions, suivant = page_transactions(criteres, request.args.get('apres'), descendant=True)
+    if request.args.get('format') == 'json':
+        return page_json(transactions, suivant)
 
-    # Graphique : total par catégorie
-    category_totals = {}
-    for tx in transactions:
-        category_totals[tx.category] = category_totals.get(tx.category, 0) + tx.amount
+    # Graphique : total par catégorie, calculé en SQL sur tout le filtre (pas seulement la page)
+    category_totals = dict(totaux_par_categorie(*criteres))
 
     return render_template('admin_transactions.html',
                            utilisateur=utilisateur,
                            transactions=transactions,
+                           suivant=suivant,
                            start_date=start_date,
                            end_date=end_date,
                            category=category,
@@ -564,12 +888,9 @@ def export_pdf_admin(user_id):
         flash("Accès refusé.")
         return redirect('/home')
 
-    txs = Transaction.query.filter_by(user_id=user_id).order_by(Transaction.date).all()
-    html = render_template('pdf_template.html', transactions=txs)
-    output = BytesIO()
-    pisa.CreatePDF(html, dest=output)
-    output.seek(0)
-    return send_file(output, as_attachment=True, download_name=f"{utilisateur.email}_transactions.pdf")
+    job_id = report_jobs.submit('pdf_template.html', {}, user_id=current_user.id,
+                                nom=f"{utilisateur.email}_transactions.pdf", transactions_de=user_id)
+    return reponse_rapport(job_id)
 
 
 # ----------------------
@@ -584,12 +905,17 @@ def admin_update_transaction():
 
     tx_id = request.form['id']
     tx = Transaction.query.get_or_404(tx_id)
+    avant = lignes_agregats([tx])
 
     tx.date = datetime.strptime(request.form['date'], '%Y-%m-%d').date()
     tx.category = request.form['category']
     tx.amount = float(request.form['amount'])
 
+    maj_agregats(avant=avant, apres=[tx])
+    evaluer_alertes(tx.user_id, {avant[0][2], tx.category})
+    invalider_prevision(tx.user_id)
     db.session.commit()
+    forecast_cache.invalidate_user(tx.user_id)
     flash("Transaction mise à jour avec succès")
     return redirect(f"/admin/utilisateur/{tx.user_id}/transactions")
 
@@ -604,6 +930,7 @@ def promouvoir_admin(user_id):
     user.is_admin = True
     user.role = "admin"  # ✅ Mettre à jour le rôle aussi
     db.session.commit()
+    user_cache.invalidate_user(user.id)
     flash(f"{user.email} est maintenant administrateur.")
     return redirect('/admin/utilisateurs')
 
@@ -618,12 +945,14 @@ def retirer_admin(user_id):
     user.is_admin = False
     user.role = "user"  # ✅ Revenir au rôle "user"
     db.session.commit()
+    user_cache.invalidate_user(user.id)
     flash(f"{user.email} n'est plus administrateur.")
     return redirect('/admin/utilisateurs')
 
 
 @app.route('/admin/dashboard')
 @login_required
+@lecture_seule
 def admin_dashboard():
     if not current_user.is_admin:
         return redirect('/home')
@@ -636,10 +965,10 @@ def admin_dashboard():
     users = users_paginated.items
     user_ids = [u.id for u in users]
 
-    transactions = Transaction.query.filter(Transaction.user_id.in_(user_ids)).all()
-    total_transactions = len(transactions)
-    total_depenses = sum(t.amount for t in transactions if t.amount < 0)
-    total_revenus = sum(t.amount for t in transactions if t.amount > 0)
+    totaux = totaux_transactions(Transaction.user_id.in_(user_ids))
+    total_transactions = totaux.nb
+    total_depenses = totaux.depenses
+    total_revenus = totaux.revenus
 
     return render_template('admin_dashboard.html',
                            users=users,
@@ -650,58 +979,1480 @@ def admin_dashboard():
 
 
 # ------------------ LES FONCTIONS UTILIES ---------------------------
+# ------------------ AGRÉGATS SQL ------------------
+# Totaux calculés par la base (COUNT / SUM(CASE ...) / GROUP BY) : aucun objet Transaction n'est chargé
+Totaux = namedtuple('Totaux', ['nb', 'revenus', 'depenses'])  # depenses négatives, comme en base
+
+REVENUS_SQL = func.coalesce(func.sum(case((Transaction.amount > 0, Transaction.amount), else_=0)), 0)
+DEPENSES_SQL = func.coalesce(func.sum(case((Transaction.amount < 0, Transaction.amount), else_=0)), 0)
+
+
+def criteres_transactions(user_id=None, start_date=None, end_date=None):
+    criteres = []
+    if user_id is not None:
+        criteres.append(Transaction.user_id == user_id)
+    if start_date:
+        criteres.append(Transaction.date >= start_date)
+    if end_date:
+        criteres.append(Transaction.date <= end_date)
+    return criteres
+
+
+def totaux_transactions(*criteres):
+    nb, revenus, depenses = db.session.query(
+        func.count(Transaction.id), REVENUS_SQL, DEPENSES_SQL
+    ).filter(*criteres).one()
+    return Totaux(nb, float(revenus), float(depenses))
+
+
+def totaux_par_utilisateur(user_ids):
+    # Une requête groupée pour une page d'utilisateurs : {user_id: Totaux}
+    lignes = db.session.query(
+        Transaction.user_id,
+        func.count(Transaction.id),
+        REVENUS_SQL,
+        DEPENSES_SQL
+    ).filter(Transaction.user_id.in_(user_ids)).group_by(Transaction.user_id)
+    return {user_id: Totaux(nb, revenus, depenses) for user_id, nb, revenus, depenses in lignes}
+
+
+def totaux_par_categorie(*criteres):
+    # [(catégorie, somme des montants)], les plus gros postes en premier
+    total = func.sum(Transaction.amount)
+    return db.session.query(Transaction.category, total) \
+        .filter(*criteres) \
+        .group_by(Transaction.category) \
+        .order_by(func.abs(total).desc()) \
+        .all()
+
+
+def categories_utilisateur(user_id):
+    return [c for (c,) in db.session.query(Transaction.category)
+            .filter(Transaction.user_id == user_id).distinct().order_by(Transaction.category)]
+
+
+def page_transactions(criteres, apres=None, taille=None, descendant=False):
+    # Pagination par curseur (date, id) : le coût d'une page ne dépend pas de sa position dans l'historique
+    taille = taille or app.config['TRANSACTIONS_PAGE_SIZE']
+    query = Transaction.query.filter(*criteres)
+    if apres:
+        jour, _, tx_id = apres.partition('_')
+        try:
+            jour, tx_id = datetime.strptime(jour, '%Y-%m-%d').date(), int(tx_id)
+        except ValueError:
+            abort(400)
+        if descendant:
+            query = query.filter(or_(Transaction.date < jour, and_(Transaction.date == jour, Transaction.id < tx_id)))
+        else:
+            query = query.filter(or_(Transaction.date > jour, and_(Transaction.date == jour, Transaction.id > tx_id)))
+    ordre = (Transaction.date.desc(), Transaction.id.desc()) if descendant else (Transaction.date, Transaction.id)
+    txs = query.order_by(*ordre).limit(taille + 1).all()
+    suivant = f"{txs[taille - 1].date.isoformat()}_{txs[taille - 1].id}" if len(txs) > taille else None
+    return txs[:taille], suivant
+
+
+def page_json(txs, suivant):
+    return jsonify({
+        "transactions": [
+            {"id": t.id, "date": t.date.isoformat(), "category": t.category, "amount": t.amount} for t in txs
+        ],
+        "suivant": suivant
+    })
+
+
+# ------------------ CACHES LRU ------------------
+class CacheLRU:
+    # Cache LRU + TTL en mémoire, partagé par les threads du process ; clés = tuples commençant par user_id
+    def __init__(self, max_size=256, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or time.monotonic() > entry[0]:
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        # ttl : durée de vie propre à cette entrée (sinon celle du cache)
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate_user(self, user_id):
+        # Les clés commencent par user_id : on ne purge que cet utilisateur
+        with self._lock:
+            for key in [k for k in self._data if k[0] == user_id]:
+                del self._data[key]
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "ttl": self.ttl
+            }
+
+
+forecast_cache = CacheLRU(app.config['FORECAST_CACHE_SIZE'], app.config['FORECAST_CACHE_TTL'])
+user_cache = CacheLRU(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])  # sessions (load_user), clés (user_id,)
+
+
+def flux_fingerprint(rows):
+    # Empreinte des flux journaliers : sha1 de chaque (jour, montant au centime), O(jours).
+    # Des sommes ne suffisent pas : déplacer une transaction entre deux jours les laisse inchangées
+    h = hashlib.sha1()
+    for jour, montant in rows:
+        h.update(f"{jour.isoformat()}|{montant:.2f};".encode())
+    return h.hexdigest()
+
+
+@app.route('/admin/cache/forecast')
+@login_required
+def forecast_cache_stats():
+    if not current_user.is_admin:
+        return redirect('/home')
+    return jsonify(dict(forecast_cache.stats(), moteurs=dict(forecast_jobs.moteurs), modeles=modeles_prevision.stats()))
+
+
+@app.route('/admin/metriques')
+@login_required
+def metriques_stats():
+    if not current_user.is_admin:
+        return redirect('/home')
+    return jsonify({
+        "depuis": datetime.utcfromtimestamp(metriques.depuis).isoformat(),
+        "mesures": metriques.resume(),
+        "pools": {cle or "principale": moteur.pool.status() for cle, moteur in db.engines.items()}
+    })
+
+
+@app.route('/admin/cache/utilisateurs')
+@login_required
+def user_cache_stats():
+    if not current_user.is_admin:
+        return redirect('/home')
+    return jsonify(user_cache.stats())
+
+
+# ------------------ TÂCHES DE PRÉVISION ------------------
+class ForecastJobs:
+    # Calculs Prophet exécutés dans un pool de processus. États des calculs et résultats sont écrits en JSON
+    # dans un dossier partagé par les processus web (à côté des modèles persistés) : le polling et le
+    # rechargement de /forecast peuvent arriver sur n'importe quel worker
+    def __init__(self, workers=2, max_derniers=256, dossier='modeles', age=3600):
+        self.workers = workers
+        self.dossier = dossier
+        self.age = age        # secondes de conservation des états et résultats
+        self._pool = None
+        self._lock = threading.Lock()
+        self._par_cle = {}    # clé de cache -> job_id en cours dans ce processus (coalescence)
+        # (user_id, fenetre) -> dernier résultat calculé, affiché pendant un recalcul ; borné comme le cache
+        # (chaque fenêtre de dates ouverte garde son historique complet) et sans expiration par durée
+        self.derniers = CacheLRU(max_derniers, ttl=float('inf'))
+        self.moteurs = Counter()  # moteur de prévision -> nombre de calculs servis
+
+    def _get_pool(self):
+        if self._pool is None:
+            # Les workers chargent pandas/Prophet dès leur démarrage, pas au premier calcul
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=precharger_dependances,
+                                             initargs=(("forecast",),))
+        return self._pool
+
+    def _chemin_job(self, job_id):
+        return os.path.join(self.dossier, 'jobs', f"{job_id}.json")
+
+    def _chemin_resultat(self, key):
+        return os.path.join(self.dossier, 'resultats', f"{hashlib.sha1(json.dumps(key).encode()).hexdigest()}.json")
+
+    def submit(self, key, rows):
+        with self._lock:
+            # Même utilisateur, même fenêtre, mêmes données : on réutilise le calcul en cours
+            job_id = self._par_cle.get(key)
+            if job_id is not None:
+                return job_id
+
+            job_id = uuid.uuid4().hex
+            job = {"id": job_id, "status": "pending", "user_id": key[0],
+                   "created": time.time(), "finished": None, "error": None}
+            ecrire_json(self._chemin_job(job_id), job)
+            self._par_cle[key] = job_id
+            options = forecast_options()
+            if self.workers > 0:
+                future = self._get_pool().submit(_avec_spans, _fit_forecast, rows, cle_modele=key[:2], **options)
+            else:
+                # FORECAST_WORKERS=0 : calcul dans le thread courant (tests, dev)
+                future = Future()
+                try:
+                    future.set_result(_avec_spans(_fit_forecast, rows, cle_modele=key[:2], **options))
+                except Exception as e:
+                    future.set_exception(e)
+
+        future.add_done_callback(lambda f: self._done(job, key, f))
+        return job_id
+
+    def _done(self, job, key, future):
+        error = future.exception()
+        job = dict(job, finished=time.time())
+        if error is None:
+            result, spans = future.result()
+            fusionner_spans(spans)
+            # Le résultat est publié avant de passer à "done" pour que le polling le trouve, quel que soit le worker
+            forecast_cache.set(key, result)
+            ecrire_json(self._chemin_resultat(key), result)
+            job["status"], job["moteur"] = "done", result["moteur"]
+        else:
+            job["status"], job["error"] = "error", str(error)
+            app.logger.error("Prévision %s en échec : %s", job["id"], error)
+        ecrire_json(self._chemin_job(job["id"]), job)
+        with self._lock:
+            self._par_cle.pop(key, None)
+            if error is None:
+                self.moteurs[job["moteur"]] += 1
+                self.derniers.set(key[:2], result)
+        self._purge()
+
+    def status(self, job_id):
+        return lire_json(self._chemin_job(job_id)) if job_id.isalnum() else None
+
+    def resultat(self, key):
+        # Résultat publié par un autre processus web, tant qu'il n'a pas expiré
+        chemin = self._chemin_resultat(key)
+        try:
+            if time.time() - os.path.getmtime(chemin) > self.age:
+                return None
+        except OSError:
+            return None
+        return lire_json(chemin)
+
+    def _purge(self):
+        limite = time.time() - self.age
+        for sous_dossier in ('jobs', 'resultats'):
+            for date_modif, _, chemin in fichiers_dossier(os.path.join(self.dossier, sous_dossier), '.json'):
+                if date_modif < limite:
+                    try:
+                        os.remove(chemin)
+                    except FileNotFoundError:
+                        pass
+
+
+forecast_jobs = ForecastJobs(app.config['FORECAST_WORKERS'], app.config['FORECAST_CACHE_SIZE'],
+                             app.config['FORECAST_MODEL_DIR'], app.config['FORECAST_CACHE_TTL'])
+
+
+@app.route('/forecast/job/<job_id>')
+@login_required
+def forecast_job_status(job_id):
+    job = forecast_jobs.status(job_id)
+    if not job or job["user_id"] != current_user.id:
+        return jsonify({"error": "introuvable"}), 404
+    return jsonify(job)
+
+
 # ------------------ FORECAST------------------
-def generate_forecast(transactions):
-    if not transactions:
-        return {'historique': [], 'prevision': [], 'alerte': False}
+def forecast_key(user_id, fenetre, rows):
+    # Cache : (user_id, filtre de dates, empreinte) → Prophet n'est pas relancé
+    return (user_id, fenetre, flux_fingerprint(rows))
+
+
+def forecast_options():
+    return {
+        "max_jours": app.config['FORECAST_MAX_HISTORY_DAYS'],
+        "cumul": app.config['FORECAST_CUMUL'],
+        "budget_ms": app.config['FORECAST_LATENCY_BUDGET_MS'],
+        "moteur": app.config['FORECAST_ENGINE']
+    }
+
+
+def preparer_serie(rows, max_jours=0, cumul=False):
+    # Série quotidienne continue (jours sans transaction = 0) : la taille du fit dépend du calendrier
+    import pandas as pd
+    serie = pd.Series(
+        [montant for _, montant in rows],
+        index=pd.DatetimeIndex([jour for jour, _ in rows])
+    ).resample('D').sum()
+    if cumul:
+        # Le solde est cumulé sur tout l'historique avant de tronquer la fenêtre
+        serie = serie.cumsum()
+    if max_jours:
+        serie = serie.iloc[-max_jours:]
+    return pd.DataFrame({"ds": serie.index, "y": serie.to_numpy()})
+
+
+def _fit_forecast(rows, max_jours=0, cumul=False, budget_ms=None, moteur=None, periodes=30, cle_modele=None):
+    # rows : [(jour, flux net du jour)], sans objet ORM pour pouvoir passer au pool de processus
+    # cle_modele : (user_id, fenetre) du modèle persisté dont Prophet peut repartir
+    import pandas as pd
+    df = preparer_serie(rows, max_jours, cumul)
+    debut = df["ds"].iloc[0].date()
 
     # Historique : on inclut type 'revenu' ou 'depense'
     historique = [
         {
-            "day": t.date.strftime('%d/%m'),
-            "value": t.amount,
-            "type": "revenu" if t.amount >= 0 else "depense"
+            "day": d.strftime('%d/%m'),
+            "value": amount,
+            "type": "revenu" if amount >= 0 else "depense"
         }
-        for t in transactions
+        for d, amount in rows if d >= debut
     ]
 
-    # Prévision avec Prophet
-    df = pd.DataFrame([(t.date, t.amount) for t in transactions], columns=["ds", "y"])
-    model = Prophet()
-    model.fit(df)
-    future = model.make_future_dataframe(periods=30)
-    forecast = model.predict(future)
-
-    prevision = forecast[['ds', 'yhat']].tail(30)
-    prevision_data = [{"day": row['ds'].strftime('%d/%m'), "value": round(row['yhat'], 2)} for _, row in prevision.iterrows()]
-    alerte = any(row['yhat'] < 0 for _, row in prevision.iterrows())
+    # Prévision : premier moteur adapté qui aboutit (Prophet, puis modèles NumPy en secours)
+    for nom in choisir_moteurs(len(df), budget_ms, moteur):
+        t0 = time.perf_counter()
+        try:
+            fonction = MOTEURS_PREVISION[nom]["fonction"]
+            yhat = fonction(df, periodes, cle_modele) if MOTEURS_PREVISION[nom].get("reprise") else fonction(df, periodes)
+        except Exception as e:
+            app.logger.warning("Moteur de prévision %s en échec, repli : %s", nom, e)
+            continue
+        duree_ms = round((time.perf_counter() - t0) * 1000, 2)
+        break
+
+    jours = pd.date_range(df["ds"].iloc[-1] + pd.Timedelta(days=1), periods=periodes, freq='D')
+    prevision_data = [{"day": d.strftime('%d/%m'), "value": round(float(v), 2)} for d, v in zip(jours, yhat)]
+    alerte = bool((yhat < 0).any())
 
     return {
         "historique": historique,
         "prevision": prevision_data,
-        "alerte": alerte
+        "alerte": alerte,
+        "moteur": nom,
+        "duree_ms": duree_ms
     }
 
+
+# ------------------ PRÉCALCUL DES PRÉVISIONS ------------------
+def prevision_disponible(key):
+    # Cache mémoire, puis prévision précalculée en base si les données n'ont pas changé depuis
+    cached = forecast_cache.get(key)
+    if cached is not None:
+        return cached
+    partage = forecast_jobs.resultat(key)
+    if partage is not None:
+        forecast_cache.set(key, partage)
+        return partage
+    user_id, fenetre, empreinte = key
+    if fenetre == (None, None):
+        stockee = db.session.get(PrevisionCalculee, user_id)
+        if stockee and stockee.empreinte == json.dumps(empreinte):
+            result = json.loads(stockee.resultat)
+            forecast_cache.set(key, result)
+            return result
+    return None
+
+
+def invalider_prevision(user_id):
+    # Appelée par chaque écriture, avant son commit : la prévision précalculée disparaît avec les données modifiées
+    db.session.query(PrevisionCalculee).filter_by(user_id=user_id).delete(synchronize_session=False)
+
+
+def precalculer_previsions(user_ids, workers=None, force=False):
+    # Chaque résultat est enregistré dès qu'il arrive : une exécution interrompue reprend
+    # là où elle s'est arrêtée (les utilisateurs déjà à jour sont ignorés)
+    stats = {"calculees": 0, "a_jour": 0, "sans_donnees": 0, "erreurs": 0}
+    debut = time.perf_counter()
+    workers = workers or os.cpu_count()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=precharger_dependances,
+                             initargs=(("forecast",),)) as pool:
+        en_cours = {}
+        for user_id in user_ids:
+            rows = flux_journaliers(user_id)
+            if not rows:
+                stats["sans_donnees"] += 1
+                continue
+            empreinte = json.dumps(flux_fingerprint(rows))
+            stockee = db.session.get(PrevisionCalculee, user_id)
+            if not force and stockee and stockee.empreinte == empreinte:
+                stats["a_jour"] += 1
+                continue
+
+            en_cours[pool.submit(_fit_forecast, rows, cle_modele=(user_id, (None, None)),
+                                 **forecast_options())] = (user_id, empreinte)
+            # Fenêtre bornée : on ne garde pas tous les utilisateurs en mémoire d'un coup
+            if len(en_cours) >= workers * 4:
+                termines, _ = wait(en_cours, return_when=FIRST_COMPLETED)
+                for future in termines:
+                    _enregistrer_prevision(future, *en_cours.pop(future), stats=stats)
+
+        for future in list(en_cours):
+            _enregistrer_prevision(future, *en_cours.pop(future), stats=stats)
+
+    stats["duree_s"] = round(time.perf_counter() - debut, 1)
+    stats["utilisateurs_par_minute"] = round(stats["calculees"] / stats["duree_s"] * 60, 1) if stats["duree_s"] else 0
+    return stats
+
+
+def _enregistrer_prevision(future, user_id, empreinte, stats):
+    try:
+        result = future.result()
+    except Exception as e:
+        stats["erreurs"] += 1
+        app.logger.error("Précalcul de la prévision user=%s en échec : %s", user_id, e)
+        return
+    db.session.merge(PrevisionCalculee(user_id=user_id, empreinte=empreinte, moteur=result["moteur"],
+                                       resultat=json.dumps(result), date_calcul=datetime.utcnow()))
+    db.session.commit()
+    stats["calculees"] += 1
+    if stats["calculees"] % 100 == 0:
+        print(f"… {stats['calculees']} prévisions calculées")
+
+
+@app.cli.command('precalculer-previsions')
+@click.option('--entreprise', default=None, help="Nom ou id de l'entreprise (toutes par défaut)")
+@click.option('--workers', type=int, default=None, help="Processus de calcul (tous les cœurs par défaut)")
+@click.option('--force', is_flag=True, help="Recalculer aussi les prévisions déjà à jour")
+def precalculer_previsions_command(entreprise, workers, force):
+    query = User.query
+    if entreprise:
+        cible = Entreprise.query.filter_by(nom=entreprise).first()
+        if not cible and entreprise.isdigit():
+            cible = db.session.get(Entreprise, int(entreprise))
+        if not cible:
+            raise click.ClickException(f"Entreprise introuvable : {entreprise}")
+        query = query.filter_by(entreprise_id=cible.id)
+    user_ids = [u for (u,) in query.with_entities(User.id).order_by(User.id)]
+
+    stats = precalculer_previsions(user_ids, workers, force)
+    print(f"✅ {stats['calculees']} prévisions calculées, {stats['a_jour']} déjà à jour, "
+          f"{stats['sans_donnees']} sans données, {stats['erreurs']} erreurs "
+          f"en {stats['duree_s']}s ({stats['utilisateurs_par_minute']} utilisateurs/min)")
+
+
+# ------------------ MOTEURS DE PRÉVISION ------------------
+# Chaque moteur reçoit la série quotidienne (ds, y) et renvoie un tableau NumPy de `periodes` valeurs
+def _prevoir_prophet(df, periodes, cle_modele=None):
+    from prophet import Prophet
+
+    empreinte = empreinte_serie(df)
+    precedent = modeles_prevision.charger(cle_modele)
+    if precedent is not None and str(precedent["empreinte"]) == empreinte and len(precedent["yhat"]) == periodes:
+        # Aucune donnée nouvelle depuis le dernier fit : pas de refit
+        return precedent["yhat"]
+
+    # Seul yhat est utilisé : pas d'échantillonnage d'incertitude
+    model = Prophet(uncertainty_samples=0)
+    if precedent is not None:
+        # Reprise à chaud : l'optimisation part des paramètres du fit précédent
+        # (Prophet garde ses valeurs par défaut pour ceux dont la forme a changé)
+        with span('prophet.fit_reprise'):
+            model.fit(df, init={nom: precedent[nom] for nom in ModelesPrevision.PARAMETRES})
+    else:
+        with span('prophet.fit'):
+            model.fit(df)
+    future = model.make_future_dataframe(periods=periodes).iloc[-periodes:]
+    yhat = model.predict(future)['yhat'].to_numpy()
+
+    params = {nom: model.params[nom].reshape(-1) for nom in ModelesPrevision.PARAMETRES}
+    params.update({nom: params[nom][0] for nom in ('k', 'm', 'sigma_obs')})
+    modeles_prevision.enregistrer(cle_modele, empreinte, params, yhat)
+    return yhat
+
+
+def _prevoir_holt_winters(df, periodes, saison=7, alpha=0.3, beta=0.05, gamma=0.2, phi=0.98):
+    # Holt-Winters additif à tendance amortie, paramètres fixes : quelques microsecondes
+    import numpy as np
+    y = df["y"].to_numpy(dtype=float)
+    niveau = y[:saison].mean()
+    tendance = (y[saison:2 * saison].mean() - niveau) / saison
+    saisons = list(y[:saison] - niveau)
+    for t in range(saison, len(y)):
+        s = saisons[t - saison]
+        precedent = niveau
+        niveau = alpha * (y[t] - s) + (1 - alpha) * (niveau + phi * tendance)
+        tendance = beta * (niveau - precedent) + (1 - beta) * phi * tendance
+        saisons.append(gamma * (y[t] - niveau) + (1 - gamma) * s)
+    amortissement = np.cumsum(phi ** np.arange(1, periodes + 1))
+    indices = len(y) + np.arange(periodes) - saison * (1 + np.arange(periodes) // saison)
+    return niveau + amortissement * tendance + np.asarray(saisons)[indices]
+
+
+def _prevoir_tendance_lineaire(df, periodes, fenetre=90):
+    # Droite des moindres carrés sur les derniers jours
+    import numpy as np
+    y = df["y"].to_numpy(dtype=float)[-fenetre:]
+    x = np.arange(len(y))
+    pente, origine = np.polyfit(x, y, 1)
+    return origine + pente * (len(y) + np.arange(periodes))
+
+
+def _prevoir_naif_saisonnier(df, periodes, saison=7):
+    # Répète la dernière semaine observée (ou la dernière valeur si l'historique est plus court)
+    import numpy as np
+    y = df["y"].to_numpy(dtype=float)
+    motif = y[-saison:] if len(y) >= saison else y[-1:]
+    return np.resize(motif, periodes)
+
+
+# Ordre de préférence ; min_jours = historique nécessaire, cout_ms = latence typique estimée
+MOTEURS_PREVISION = {
+    "prophet": {"fonction": _prevoir_prophet, "min_jours": 60, "cout_ms": 2000, "reprise": True},
+    "holt_winters": {"fonction": _prevoir_holt_winters, "min_jours": 14, "cout_ms": 5},
+    "tendance_lineaire": {"fonction": _prevoir_tendance_lineaire, "min_jours": 2, "cout_ms": 1},
+    "naif_saisonnier": {"fonction": _prevoir_naif_saisonnier, "min_jours": 1, "cout_ms": 1},
+}
+
+
+def choisir_moteurs(nb_jours, budget_ms=None, moteur=None):
+    # Candidats dans l'ordre : moteur forcé, puis ceux compatibles avec l'historique et le budget
+    candidats = [
+        nom for nom, m in MOTEURS_PREVISION.items()
+        if nb_jours >= m["min_jours"] and (not budget_ms or m["cout_ms"] <= budget_ms)
+    ]
+    if moteur in MOTEURS_PREVISION:
+        candidats.insert(0, moteur)
+    # Le modèle naïf ne peut pas échouer : il reste toujours en dernier recours
+    return list(dict.fromkeys(candidats + ["naif_saisonnier"]))
+
+
+# ------------------ MODÈLES PROPHET PERSISTÉS ------------------
+def empreinte_serie(df):
+    # Empreinte de la série réellement ajustée (après fenêtre et remplissage des jours vides)
+    h = hashlib.sha1(df["ds"].to_numpy().astype('datetime64[D]').tobytes())
+    h.update(df["y"].to_numpy(dtype=float).tobytes())
+    return h.hexdigest()
+
+
+def ecrire_json(chemin, donnees):
+    # Écriture atomique : un autre processus lit l'ancien ou le nouveau fichier, jamais un fichier partiel
+    os.makedirs(os.path.dirname(chemin), exist_ok=True)
+    temporaire = f"{chemin}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporaire, 'w') as f:
+        json.dump(donnees, f)
+    os.replace(temporaire, chemin)
+
+
+def lire_json(chemin):
+    try:
+        with open(chemin) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def fichiers_dossier(dossier, extension):
+    # [(date de modification, taille, chemin)] des fichiers du dossier ayant cette extension
+    try:
+        entrees = [e for e in os.scandir(dossier) if e.name.endswith(extension)]
+    except FileNotFoundError:
+        return []
+    fichiers = []
+    for entree in entrees:
+        try:
+            infos = entree.stat()
+        except FileNotFoundError:
+            continue
+        fichiers.append((infos.st_mtime, infos.st_size, entree.path))
+    return fichiers
+
+
+def evincer_dossier(dossier, extension, max_octets):
+    # Taille bornée : les fichiers utilisés le moins récemment (date de modification) sont supprimés en premier
+    fichiers = fichiers_dossier(dossier, extension)
+    total = sum(taille for _, taille, _ in fichiers)
+    for _, taille, chemin in sorted(fichiers):
+        if total <= max_octets:
+            break
+        try:
+            os.remove(chemin)
+        except FileNotFoundError:
+            pass
+        total -= taille
+
+
+class ModelesPrevision:
+    # Un fichier .npz compressé (quelques Ko) par (utilisateur, fenêtre) : paramètres du dernier fit,
+    # empreinte de la série et prévision. Partagé par tous les processus de calcul via le disque.
+    VERSION = 1  # à incrémenter si le contenu change : les fichiers d'une autre version sont ignorés
+    PARAMETRES = ('k', 'm', 'sigma_obs', 'delta', 'beta')
+
+    def __init__(self, dossier, max_octets):
+        self.dossier = dossier
+        self.max_octets = max_octets
+
+    def _chemin(self, cle):
+        user_id, fenetre = cle
+        suffixe = hashlib.sha1(json.dumps(fenetre).encode()).hexdigest()[:12]
+        return os.path.join(self.dossier, f"{user_id}-{suffixe}.npz")
+
+    def charger(self, cle):
+        if cle is None or not self.max_octets:
+            return None
+        import numpy as np
+        chemin = self._chemin(cle)
+        try:
+            with np.load(chemin, allow_pickle=False) as fichier:
+                if int(fichier["version"]) != self.VERSION:
+                    return None
+                modele = {nom: fichier[nom] for nom in fichier.files}
+            os.utime(chemin)  # date de modification = dernier usage, pour l'éviction
+        except (OSError, ValueError, KeyError):
+            return None
+        return modele
+
+    def enregistrer(self, cle, empreinte, params, yhat):
+        if cle is None or not self.max_octets:
+            return
+        import numpy as np
+        os.makedirs(self.dossier, exist_ok=True)
+        chemin = self._chemin(cle)
+        # Écriture atomique : plusieurs workers peuvent enregistrer en même temps
+        temporaire = f"{chemin}.{os.getpid()}.tmp"
+        with open(temporaire, 'wb') as fichier:
+            np.savez_compressed(fichier, version=self.VERSION, empreinte=empreinte, yhat=yhat, **params)
+        os.replace(temporaire, chemin)
+        evincer_dossier(self.dossier, '.npz', self.max_octets)
+
+    def stats(self):
+        fichiers = fichiers_dossier(self.dossier, '.npz')
+        return {
+            "modeles": len(fichiers),
+            "octets": sum(taille for _, taille, _ in fichiers),
+            "max_octets": self.max_octets,
+            "version": self.VERSION
+        }
+
+
+modeles_prevision = ModelesPrevision(app.config['FORECAST_MODEL_DIR'], app.config['FORECAST_MODEL_DIR_MB'] * 1024 * 1024)
+
+
+# ------------------ SIMULATION DE TRÉSORERIE ------------------
+# Monte Carlo par rééchantillonnage de jours entiers de l'historique (bootstrap) : chaque trajectoire
+# tire `horizon` jours passés au hasard, avec toutes leurs catégories, et cumule leurs flux.
+def simuler_tresorerie(jours, categories, montants, solde_initial, ajustements=None,
+                       chemins=10000, horizon=90, graine=None):
+    # jours / categories / montants : flux net par (jour, catégorie) ; ajustements : {catégorie: facteur}
+    import numpy as np
+
+    debut_calcul = time.perf_counter()
+    jours = np.asarray(jours, dtype='datetime64[D]')
+    premier = jours.min()
+    noms, colonnes = np.unique(np.asarray(categories, dtype=object), return_inverse=True)
+
+    # Matrice (jours calendaires × catégories) : les jours sans transaction comptent comme des jours à 0 €
+    flux = np.zeros(((jours.max() - premier).astype(int) + 1, len(noms)))
+    np.add.at(flux, ((jours - premier).astype(int), colonnes), np.asarray(montants, dtype=float))
+    facteurs = np.array([(ajustements or {}).get(nom, 1.0) for nom in noms])
+    flux_jour = flux @ facteurs
+
+    rng = np.random.default_rng(graine)
+    soldes = flux_jour[rng.integers(0, len(flux_jour), size=(chemins, horizon))]
+    np.cumsum(soldes, axis=1, out=soldes)
+    soldes += solde_initial
+
+    negatif = soldes < 0
+    decouvert = negatif.any(axis=1)
+    # Jours avant le premier solde négatif ; horizon + 1 pour une trajectoire jamais à découvert
+    autonomie = np.where(decouvert, negatif.argmax(axis=1) + 1, horizon + 1)
+    p_autonomie = np.percentile(autonomie, [10, 50, 90], method='lower')
+    p_final = np.percentile(soldes[:, -1], [10, 50, 90])
+    return {
+        "chemins": chemins,
+        "horizon": horizon,
+        "jours_historique": len(flux_jour),
+        "solde_initial": round(float(solde_initial), 2),
+        "proba_decouvert": round(float(decouvert.mean()), 4),
+        "autonomie": {f"p{q}": int(v) for q, v in zip((10, 50, 90), p_autonomie)},
+        "solde_final": {f"p{q}": round(float(v), 2) for q, v in zip((10, 50, 90), p_final)},
+        "ajustements": {nom: f for nom, f in (ajustements or {}).items() if nom in set(noms)},
+        "duree_ms": round((time.perf_counter() - debut_calcul) * 1000, 2)
+    }
+
+
+def simulation_tresorerie(user_id, start_date=None, end_date=None, ajustements=None):
+    # Sans fenêtre : les SIMULATION_HISTORY_DAYS derniers jours d'historique
+    if not start_date:
+        dernier = db.session.query(func.max(SoldeJournalier.jour)).filter(SoldeJournalier.user_id == user_id)
+        if end_date:
+            dernier = dernier.filter(SoldeJournalier.jour <= end_date)
+        dernier = dernier.scalar()
+        if dernier is None:
+            return None
+        start_date = (dernier - timedelta(days=app.config['SIMULATION_HISTORY_DAYS'] - 1)).isoformat()
+
+    lignes = db.session.query(Transaction.date, Transaction.category, func.sum(Transaction.amount)) \
+        .filter(*criteres_transactions(user_id, start_date, end_date)) \
+        .group_by(Transaction.date, Transaction.category).all()
+    if not lignes:
+        return None
+    solde = db.session.query(func.coalesce(func.sum(SoldeJournalier.revenus + SoldeJournalier.depenses), 0)) \
+        .filter(*criteres_agregats(SoldeJournalier.jour, user_id, None, end_date)).scalar()
+
+    jours, categories, montants = zip(*lignes)
+    with span('simulation.monte_carlo'):
+        return simuler_tresorerie(jours, categories, montants, solde, ajustements,
+                                  chemins=app.config['SIMULATION_PATHS'], horizon=app.config['SIMULATION_HORIZON'],
+                                  graine=user_id)
+
+
+# ------------------ IMPORT CSV ------------------
+IMPORT_COLONNES = ['date', 'category', 'amount']
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+# Dédoublonnage : une ligne est identifiée par son contenu et son rang parmi les lignes identiques du fichier.
+# Deux achats identiques le même jour restent deux transactions ; un relevé réimporté redonne les mêmes empreintes.
+def contenu_transaction(jour, category, amount):
+    return f"{jour.isoformat()}|{category}|{amount:.2f}"
+
+
+def empreinte_transaction(user_id, contenu, rang):
+    return hashlib.blake2b(f"{user_id}|{contenu}|{rang}".encode(), digest_size=16).hexdigest()
+
+
+class CompteurContenus:
+    # Lignes déjà vues par contenu dans les lots précédents du fichier importé. Les compteurs sont gardés dans
+    # une base SQLite temporaire sur disque (clé = condensé de 16 octets), supprimée à la fermeture :
+    # la mémoire reste celle d'un lot quelle que soit la taille du fichier, même s'il n'est pas trié par date
+    def __init__(self):
+        self._base = sqlite3.connect('')  # nom vide : base privée sur disque, effacée par close()
+        self._base.execute("PRAGMA journal_mode=OFF")
+        self._base.execute("PRAGMA synchronous=OFF")
+        self._base.execute("CREATE TABLE vus (cle BLOB PRIMARY KEY, nb INTEGER NOT NULL) WITHOUT ROWID")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._base.close()
+
+    def ajouter(self, contenus, lot=10000):
+        # Renvoie, pour chaque ligne du lot, le nombre de lignes identiques des lots précédents, puis compte le lot
+        cles = {c: hashlib.blake2b(c.encode(), digest_size=16).digest() for c in contenus.unique()}
+        liste = list(cles.values())
+        deja = {}
+        for i in range(0, len(liste), lot):
+            partie = liste[i:i + lot]
+            deja.update(self._base.execute(
+                f"SELECT cle, nb FROM vus WHERE cle IN ({','.join('?' * len(partie))})", partie))
+        self._base.executemany(
+            "INSERT INTO vus VALUES (?, ?) ON CONFLICT(cle) DO UPDATE SET nb = nb + excluded.nb",
+            [(cles[c], int(nb)) for c, nb in contenus.value_counts().items()])
+        return contenus.map(lambda c: deja.get(cles[c], 0))
+
+
+def empreintes_import(lignes, user_id, vus):
+    # vus : CompteurContenus du fichier en cours d'import
+    import pandas as pd
+    contenus = pd.Series([contenu_transaction(*l) for l in zip(lignes["date"], lignes["category"], lignes["amount"])])
+    rangs = contenus.groupby(contenus).cumcount() + vus.ajouter(contenus)
+    return [empreinte_transaction(user_id, c, r) for c, r in zip(contenus, rangs)]
+
+
+def empreintes_existantes(user_id, empreintes, lot=10000):
+    # Une requête IN par lot d'import, servie par l'index (user_id, empreinte)
+    existantes = set()
+    for i in range(0, len(empreintes), lot):
+        existantes.update(e for (e,) in db.session.query(Transaction.empreinte).filter(
+            Transaction.user_id == user_id, Transaction.empreinte.in_(empreintes[i:i + lot])))
+    return existantes
+
+
+def remplir_empreintes(lot=5000):
+    # Migration : les transactions antérieures à la colonne sont traitées comme déjà importées,
+    # avec leur rang dans l'ordre d'insertion. Rien ne distingue alors une saisie manuelle d'une ligne importée :
+    # une saisie antérieure masque une ligne CSV identique, une saisie postérieure (empreinte NULL) non.
+    vus, user_courant, maj, total = Counter(), None, [], 0
+    requete = db.session.query(Transaction.id, Transaction.user_id, Transaction.date, Transaction.category,
+                               Transaction.amount).filter(Transaction.empreinte.is_(None))
+    for tx_id, user_id, jour, category, amount in requete.order_by(Transaction.user_id, Transaction.id).yield_per(lot):
+        if user_id != user_courant:
+            vus, user_courant = Counter(), user_id
+        contenu = contenu_transaction(jour, category, amount)
+        maj.append({"id": tx_id, "empreinte": empreinte_transaction(user_id, contenu, vus[contenu])})
+        vus[contenu] += 1
+        if len(maj) >= lot:
+            total += len(maj)
+            db.session.bulk_update_mappings(Transaction, maj)
+            maj = []
+    if maj:
+        total += len(maj)
+        db.session.bulk_update_mappings(Transaction, maj)
+    db.session.commit()
+    return total
+
+
+def dates_import(valeurs):
+    # format='mixed' : chaque valeur est interprétée seule (2025-02-05, 2025-02-05T10:00:00, 2025-02-03 08:00...),
+    # sinon pandas fixe le format sur la première ligne et rejette toutes les autres
+    import pandas as pd
+    try:
+        return pd.to_datetime(valeurs, errors='coerce', format='mixed')
+    except ValueError:
+        # Fuseaux horaires différents dans le même lot : conversion ligne à ligne, heure locale conservée
+        dates = [pd.to_datetime(v, errors='coerce') for v in valeurs]
+        return pd.to_datetime(pd.Series([d if pd.isna(d) or d.tzinfo is None else d.tz_localize(None) for d in dates],
+                                        index=valeurs.index, dtype=object))
+
+
+def import_transactions_csv(source, user_id, chunksize=None, compression=None):
+    # Lecture par lots : la mémoire reste bornée par la taille d'un lot, pas par celle du fichier
+    import pandas as pd
+    chunksize = chunksize or app.config['IMPORT_CHUNK_SIZE']
+    stats = {"inserees": 0, "ignorees": 0, "rejetees": 0, "motifs": {}, "exemples": [], "duree": 0.0,
+             "lignes_par_sec": 0.0, "categories": set()}
+    debut = time.perf_counter()
+    ligne = 2  # la ligne 1 du fichier est l'en-tête
+
+    try:
+        lots = pd.read_csv(source, chunksize=chunksize, usecols=IMPORT_COLONNES, dtype={'category': str},
+                           compression=compression)
+    except ValueError:
+        raise ValueError(f"colonnes attendues : {', '.join(IMPORT_COLONNES)}")
+
+    # pd.read_csv lit le fichier au fil des lots : on cumule le temps passé à attendre chaque lot
+    lecture = 0.0
+    debut_lot = time.perf_counter()
+    with CompteurContenus() as vus:
+        for chunk in lots:
+            lecture += time.perf_counter() - debut_lot
+            # Conversion vectorisée de tout le lot (au lieu d'un pd.to_datetime par ligne)
+            dates = dates_import(chunk['date'])
+            montants = pd.to_numeric(chunk['amount'], errors='coerce')
+            categories = chunk['category'].str.strip()
+
+            motifs = pd.Series(None, index=chunk.index, dtype=object)
+            motifs[categories.isna() | (categories == '')] = "catégorie manquante"
+            motifs[montants.isna()] = "montant invalide"
+            motifs[dates.isna()] = "date invalide"
+            rejet = motifs.notna()
+
+            if rejet.any():
+                for motif, nb in motifs[rejet].value_counts().items():
+                    stats["motifs"][motif] = stats["motifs"].get(motif, 0) + int(nb)
+                for position in rejet.to_numpy().nonzero()[0][:10 - len(stats["exemples"])]:
+                    stats["exemples"].append((ligne + int(position), motifs.iloc[position]))
+                stats["rejetees"] += int(rejet.sum())
+
+            valides = pd.DataFrame({
+                "date": dates[~rejet].dt.date,
+                "category": categories[~rejet],
+                "amount": montants[~rejet].astype(float),
+                "user_id": user_id
+            })
+            if len(valides):
+                # Lignes déjà présentes en base (relevé réimporté ou chevauchant) : ignorées
+                valides["empreinte"] = empreintes_import(valides, user_id, vus)
+                doublons = valides["empreinte"].isin(empreintes_existantes(user_id, valides["empreinte"].tolist()))
+                stats["ignorees"] += int(doublons.sum())
+                valides = valides[~doublons]
+            if len(valides):
+                # Insertion groupée (executemany), une transaction SQL par lot
+                db.session.bulk_insert_mappings(Transaction, valides.to_dict('records'))
+                appliquer_deltas(*deltas_dataframe(valides))
+                db.session.commit()
+                stats["inserees"] += len(valides)
+                stats["categories"].update(valides["category"].unique())
+            ligne += len(chunk)
+            debut_lot = time.perf_counter()
+    enregistrer_span('pd.read_csv', lecture * 1000)
+
+    stats["duree"] = round(time.perf_counter() - debut, 3)
+    total = stats["inserees"] + stats["ignorees"] + stats["rejetees"]
+    stats["lignes_par_sec"] = round(total / stats["duree"]) if stats["duree"] else total
+    app.logger.info("Import CSV user=%s : %s", user_id, stats)
+    return stats
+
+
+def format_import_stats(stats):
+    message = f"{stats['inserees']} transactions importées ({stats['lignes_par_sec']} lignes/s)"
+    if stats["ignorees"]:
+        message += f" — {stats['ignorees']} doublons ignorés (déjà importés)"
+    if stats["rejetees"]:
+        motifs = ", ".join(f"{motif} ×{nb}" for motif, nb in stats["motifs"].items())
+        lignes = ", ".join(str(l) for l, _ in stats["exemples"])
+        message += f" — {stats['rejetees']} lignes rejetées : {motifs} (lignes {lignes})"
+    return message
+
     
-# ------------------ ALERTES IA ------------------
+# ------------------ AGRÉGATS JOURNALIERS / MENSUELS ------------------
+# SoldeJournalier et CategorieMensuelle sont mis à jour dans la même transaction SQL que les écritures
+AGREGATS = (
+    (SoldeJournalier, ['user_id', 'jour']),
+    (CategorieMensuelle, ['user_id', 'category', 'mois']),
+)
+
+
+def lignes_agregats(transactions):
+    # Copie (user_id, date, catégorie, montant) avant modification d'une transaction
+    return [(t.user_id, t.date, t.category, float(t.amount)) for t in transactions]
+
+
+def maj_agregats(avant=(), apres=()):
+    # avant : valeurs à retirer (suppression / ancienne version), apres : valeurs à ajouter
+    if avant and not isinstance(avant[0], tuple):
+        avant = lignes_agregats(avant)
+    jours, mois = {}, {}
+    for sens, lignes in ((-1, avant), (1, lignes_agregats(apres))):
+        for user_id, jour, category, amount in lignes:
+            revenus, depenses = (amount, 0.0) if amount > 0 else (0.0, amount)
+            for acc, cle in ((jours, (user_id, jour)), (mois, (user_id, category, jour.replace(day=1)))):
+                delta = acc.setdefault(cle, [0.0, 0.0, 0])
+                delta[0] += sens * revenus
+                delta[1] += sens * depenses
+                delta[2] += sens
+    appliquer_deltas(
+        [{"user_id": u, "jour": j, "revenus": r, "depenses": d, "nb": n} for (u, j), (r, d, n) in jours.items()],
+        [{"user_id": u, "category": c, "mois": m, "revenus": r, "depenses": d, "nb": n} for (u, c, m), (r, d, n) in mois.items()]
+    )
+
+
+def deltas_dataframe(df):
+    # Version groupée pour l'import : un delta par (jour) et par (catégorie, mois) pour tout le lot
+    import pandas as pd
+    df = df.assign(
+        revenus=df['amount'].clip(lower=0),
+        depenses=df['amount'].clip(upper=0),
+        mois=pd.to_datetime(df['date']).dt.to_period('M').dt.start_time.dt.date
+    )
+    colonnes = dict(revenus=('revenus', 'sum'), depenses=('depenses', 'sum'), nb=('amount', 'size'))
+    jours = df.groupby(['user_id', 'date']).agg(**colonnes).reset_index().rename(columns={'date': 'jour'})
+    mois = df.groupby(['user_id', 'category', 'mois']).agg(**colonnes).reset_index()
+    return jours.to_dict('records'), mois.to_dict('records')
+
+
+def appliquer_deltas(jours, mois):
+    for (model, cles), deltas in zip(AGREGATS, (jours, mois)):
+        if deltas:
+            _upsert_deltas(model, cles, deltas)
+    # Les lignes vidées par une suppression ou une modification disparaissent
+    user_ids = {d["user_id"] for d in jours}
+    for model, _ in AGREGATS:
+        if user_ids:
+            db.session.query(model).filter(model.user_id.in_(user_ids), model.nb <= 0) \
+                .delete(synchronize_session=False)
+
+
+def _upsert_deltas(model, cles, deltas, lot=1000):
+    dialect = db.engine.dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        # INSERT ... ON CONFLICT DO UPDATE : incrément atomique, sans lecture préalable
+        for debut in range(0, len(deltas), lot):
+            stmt = insert(model).values(deltas[debut:debut + lot])
+            stmt = stmt.on_conflict_do_update(index_elements=cles, set_={
+                col: getattr(model, col) + getattr(stmt.excluded, col) for col in ('revenus', 'depenses', 'nb')
+            })
+            db.session.execute(stmt)
+    else:
+        for delta in deltas:
+            ligne = db.session.get(model, tuple(delta[c] for c in cles))
+            if ligne is None:
+                db.session.add(model(**delta))
+            else:
+                ligne.revenus += delta["revenus"]
+                ligne.depenses += delta["depenses"]
+                ligne.nb += delta["nb"]
+
+
+def _debut_mois_sql(colonne):
+    if db.engine.dialect.name == 'sqlite':
+        return func.date(colonne, 'start of month')
+    return db.cast(func.date_trunc('month', colonne), db.Date)
+
+
+def reconstruire_agregats(user_id=None):
+    # Recalcul complet depuis Transaction (migration ou réparation)
+    criteres = [Transaction.user_id == user_id] if user_id is not None else []
+    for model, _ in AGREGATS:
+        query = db.session.query(model)
+        if user_id is not None:
+            query = query.filter(model.user_id == user_id)
+        query.delete(synchronize_session=False)
+
+    mois = _debut_mois_sql(Transaction.date)
+    db.session.execute(db.insert(SoldeJournalier).from_select(
+        ['user_id', 'jour', 'revenus', 'depenses', 'nb'],
+        db.select(Transaction.user_id, Transaction.date, REVENUS_SQL, DEPENSES_SQL, func.count(Transaction.id))
+        .where(*criteres).group_by(Transaction.user_id, Transaction.date)
+    ))
+    db.session.execute(db.insert(CategorieMensuelle).from_select(
+        ['user_id', 'category', 'mois', 'revenus', 'depenses', 'nb'],
+        db.select(Transaction.user_id, Transaction.category, mois, REVENUS_SQL, DEPENSES_SQL, func.count(Transaction.id))
+        .where(*criteres).group_by(Transaction.user_id, Transaction.category, mois)
+    ))
+    db.session.commit()
+    if user_id is not None:
+        forecast_cache.invalidate_user(user_id)
+
+
+@app.cli.command('reconstruire-agregats')
+@click.option('--user-id', type=int, default=None, help="Limiter à un utilisateur")
+def reconstruire_agregats_command(user_id):
+    debut = time.perf_counter()
+    reconstruire_agregats(user_id)
+    print(f"✅ Agrégats reconstruits en {time.perf_counter() - debut:.1f}s")
+
+
+def criteres_agregats(colonne, user_id, start_date=None, end_date=None):
+    criteres = [colonne.class_.user_id == user_id]
+    if start_date:
+        criteres.append(colonne >= start_date)
+    if end_date:
+        criteres.append(colonne <= end_date)
+    return criteres
+
+
+def flux_journaliers(user_id, start_date=None, end_date=None):
+    # [(jour, flux net)] : une ligne par jour, quel que soit le nombre de transactions
+    return [
+        (jour, revenus + depenses)
+        for jour, revenus, depenses in db.session.query(
+            SoldeJournalier.jour, SoldeJournalier.revenus, SoldeJournalier.depenses
+        ).filter(*criteres_agregats(SoldeJournalier.jour, user_id, start_date, end_date))
+        .order_by(SoldeJournalier.jour)
+    ]
+
+
+def _mois_entiers(start_date, end_date):
+    # Bornes (1er mois, 1er du dernier mois) si la fenêtre couvre des mois entiers, sinon None
+    start = datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else None
+    end = datetime.strptime(end_date, '%Y-%m-%d').date() if end_date else None
+    if start and start.day != 1:
+        return None
+    if end and (end + timedelta(days=1)).day != 1:
+        return None
+    return start, end.replace(day=1) if end else None
+
+
+def totaux_categories(user_id, start_date=None, end_date=None):
+    # [(catégorie, revenus, dépenses)] : agrégats mensuels si possible, sinon GROUP BY sur Transaction
+    bornes = _mois_entiers(start_date, end_date)
+    if bornes is None:
+        return db.session.query(Transaction.category, REVENUS_SQL, DEPENSES_SQL) \
+            .filter(*criteres_transactions(user_id, start_date, end_date)) \
+            .group_by(Transaction.category).all()
+
+    return db.session.query(
+        CategorieMensuelle.category,
+        func.sum(CategorieMensuelle.revenus),
+        func.sum(CategorieMensuelle.depenses)
+    ).filter(*criteres_agregats(CategorieMensuelle.mois, user_id, *bornes)) \
+        .group_by(CategorieMensuelle.category).all()
 
-def generate_alerts(transactions):
-    alerts = []
-    total = sum(t.amount for t in transactions)
+
+# ------------------ ALERTES IA ------------------
+# Les alertes sont recalculées à chaque écriture (depuis les agrégats, jamais depuis Transaction)
+# et stockées dans Alerte : /home et /transactions ne font qu'une lecture.
+PERIODES_BUDGET = {
+    # période → (début de la période contenant un mois, fin de période, libellé)
+    'mensuel': (lambda mois: mois,
+                lambda debut: (debut.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1),
+                lambda debut: debut.strftime('%m/%Y')),
+    'annuel': (lambda mois: mois.replace(month=1),
+               lambda debut: debut.replace(month=12, day=31),
+               lambda debut: debut.strftime('%Y')),
+}
+
+
+def alertes_attendues(user_id, budgets):
+    # {cle: valeurs de l'alerte} pour toutes les périodes des budgets donnés
+    attendues = {}
+    total = db.session.query(func.coalesce(func.sum(SoldeJournalier.revenus + SoldeJournalier.depenses), 0)) \
+        .filter(SoldeJournalier.user_id == user_id).scalar()
     if total < 0:
-        alerts.append("⚠️ Solde total négatif : attention au découvert.")
-    
-    # 🔔 Alerte si dépassement du budget
-    # Alertes budget
-    user_id = transactions[0].user_id if transactions else None
-    if user_id:
-        budgets = Budget.query.filter_by(user_id=user_id).all()
+        attendues["solde"] = dict(message="⚠️ Solde total négatif : attention au découvert.", montant=round(total, 2))
+
+    if not budgets:
+        return attendues
+
+    # Un seul passage sur les agrégats (catégorie, mois) des catégories budgétées
+    flux = {}  # (catégorie, période, début) -> flux net
+    for category, mois, net in db.session.query(
+        CategorieMensuelle.category, CategorieMensuelle.mois,
+        CategorieMensuelle.revenus + CategorieMensuelle.depenses
+    ).filter(CategorieMensuelle.user_id == user_id,
+             CategorieMensuelle.category.in_({b.category for b in budgets})):
+        for periode, (debut_periode, _, _) in PERIODES_BUDGET.items():
+            cle = (category, periode, debut_periode(mois))
+            flux[cle] = flux.get(cle, 0.0) + net
+
+    for (category, periode, debut), net in flux.items():
+        _, fin_periode, libelle = PERIODES_BUDGET[periode]
         for budget in budgets:
-            total_cat = sum(t.amount for t in transactions if t.category == budget.category)
-            if abs(total_cat) > budget.montant_max:
-                alerts.append(f"🚨 Dépassement du budget pour {budget.category} : {abs(total_cat)} € > {budget.montant_max} €")
+            if budget.category == category and budget.periode == periode and abs(net) > budget.montant_max:
+                attendues[f"budget:{budget.id}:{debut.isoformat()}"] = dict(
+                    message=f"🚨 Dépassement du budget pour {category} ({libelle(debut)}) : "
+                            f"{round(abs(net), 2)} € > {budget.montant_max} €",
+                    budget_id=budget.id, debut=debut, fin=fin_periode(debut), montant=round(net, 2)
+                )
+    return attendues
+
+
+def evaluer_alertes(user_id, categories=None):
+    # Synchronise Alerte avec les agrégats (sans commit). categories : celles qu'une écriture a touchées ;
+    # seuls leurs budgets (et le solde) sont réévalués, les alertes des autres catégories ne bougent pas.
+    # Rejouer l'appel donne le même état : écriture par (user_id, cle), jamais d'insertion en double.
+    budgets = Budget.query.filter_by(user_id=user_id)
+    if categories is not None:
+        budgets = budgets.filter(Budget.category.in_(categories))
+    budgets = budgets.all()
+    attendues = alertes_attendues(user_id, budgets)
+
+    portee = db.session.query(Alerte.cle).filter(Alerte.user_id == user_id)
+    if categories is not None:
+        portee = portee.filter(or_(Alerte.budget_id.is_(None), Alerte.budget_id.in_([b.id for b in budgets])))
+    obsoletes = [cle for (cle,) in portee if cle not in attendues]
+    if obsoletes:
+        db.session.query(Alerte).filter(Alerte.user_id == user_id, Alerte.cle.in_(obsoletes)) \
+            .delete(synchronize_session=False)
+    if attendues:
+        _upsert_alertes([dict(valeurs, user_id=user_id, cle=cle) for cle, valeurs in attendues.items()])
+
+
+def _upsert_alertes(alertes, lot=500):
+    colonnes = ('message', 'budget_id', 'debut', 'fin', 'montant')
+    alertes = [dict({c: None for c in colonnes}, date=datetime.utcnow(), **a) for a in alertes]
+    dialect = db.engine.dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        # Une alerte inchangée garde sa date : seul un nouveau dépassement (ou un montant différent) la rafraîchit
+        for debut in range(0, len(alertes), lot):
+            stmt = insert(Alerte).values(alertes[debut:debut + lot])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['user_id', 'cle'],
+                set_={c: getattr(stmt.excluded, c) for c in colonnes + ('date',)},
+                where=Alerte.message != stmt.excluded.message
+            )
+            db.session.execute(stmt)
+    else:
+        existantes = {a.cle: a for a in Alerte.query.filter(
+            Alerte.user_id == alertes[0]["user_id"], Alerte.cle.in_([a["cle"] for a in alertes]))}
+        for valeurs in alertes:
+            alerte = existantes.get(valeurs["cle"])
+            if alerte is None:
+                db.session.add(Alerte(**valeurs))
+            elif alerte.message != valeurs["message"]:
+                for champ, valeur in valeurs.items():
+                    setattr(alerte, champ, valeur)
+
+
+@app.cli.command('evaluer-alertes')
+@click.option('--user-id', type=int, default=None, help="Limiter à un utilisateur")
+def evaluer_alertes_command(user_id):
+    user_ids = [user_id] if user_id is not None else [u for (u,) in db.session.query(User.id)]
+    for uid in user_ids:
+        evaluer_alertes(uid)
+    db.session.commit()
+    print(f"✅ Alertes évaluées pour {len(user_ids)} utilisateur(s)")
+
+
+def generate_alerts(user_id, start_date=None, end_date=None, limite=20):
+    # Alertes stockées dont la période recoupe la fenêtre affichée ; le solde d'abord, puis les plus récentes
+    query = Alerte.query.filter_by(user_id=user_id)
+    if start_date:
+        query = query.filter(or_(Alerte.fin.is_(None), Alerte.fin >= start_date))
+    if end_date:
+        query = query.filter(or_(Alerte.debut.is_(None), Alerte.debut <= end_date))
+    return [a.message for a in query.order_by(Alerte.debut.isnot(None), Alerte.debut.desc()).limit(limite)]
+
+
+# ------------------ TÂCHES RAPPORTS PDF ------------------
+class ReportJobs:
+    # File de rendus PDF : pool de processus borné (REPORT_WORKERS) pour ne pas affamer les workers web.
+    # Documents rangés par empreinte de contenu dans REPORT_DIR, état des rendus dans REPORT_DIR/jobs :
+    # le dossier est partagé par les processus web, le suivi et le téléchargement marchent depuis n'importe lequel
+    def __init__(self, workers=2, dossier='rapports', max_octets=0):
+        self.workers = workers
+        self.dossier = dossier
+        self.max_octets = max_octets  # 0 = pas de limite
+        self._pool = None
+        self._lock = threading.Lock()
+        self._par_cle = {}    # empreinte de la demande -> job_id en cours dans ce processus (coalescence)
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker_rapport)
+        return self._pool
+
+    def chemin(self, empreinte):
+        return os.path.join(self.dossier, f"{empreinte}.pdf")
+
+    def _chemin_job(self, job_id):
+        return os.path.join(self.dossier, 'jobs', f"{job_id}.json")
+
+    def submit(self, template, contexte, user_id, nom, forecast_rows=None, prevision=None, transactions_de=None):
+        # transactions_de : user_id dont les transactions sont lues par le worker (exports), pas par la requête
+        options = forecast_options() if forecast_rows is not None else None
+        spec = {"template": template, "contexte": contexte, "forecast_rows": forecast_rows, "options": options,
+                "transactions_de": transactions_de, "user_id": user_id, "nom": nom}
+        cle = hashlib.sha256(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()
+
+        with self._lock:
+            # Même demande déjà en cours : on suit le même rendu
+            job_id = self._par_cle.get(cle)
+            if job_id is not None:
+                return job_id
+            job_id = uuid.uuid4().hex
+            job = {"id": job_id, "status": "pending", "user_id": user_id, "nom": nom, "empreinte": None,
+                   "created": time.time(), "finished": None, "error": None}
+            ecrire_json(self._chemin_job(job_id), job)
+            self._par_cle[cle] = job_id
+
+            args = (template, contexte, self.dossier, cle, forecast_rows, options, prevision, transactions_de)
+            if self.workers > 0:
+                future = self._get_pool().submit(_avec_spans, _rendre_pdf, *args)
+            else:
+                future = Future()
+                try:
+                    future.set_result(_avec_spans(_rendre_pdf, *args))
+                except Exception as e:
+                    future.set_exception(e)
+        future.add_done_callback(lambda f: self._done(job, cle, f))
+        return job_id
+
+    def _done(self, job, cle, future):
+        error = future.exception()
+        with self._lock:
+            self._par_cle.pop(cle, None)
+        job = dict(job, finished=time.time())
+        if error is not None:
+            job["status"], job["error"] = "error", str(error)
+            app.logger.error("Rendu PDF %s en échec : %s", job["id"], error)
+        else:
+            empreinte, spans = future.result()
+            job["status"], job["empreinte"] = "done", empreinte
+        ecrire_json(self._chemin_job(job["id"]), job)
+        if error is None:
+            fusionner_spans(spans)
+            self._evincer()
+
+    def status(self, job_id):
+        return lire_json(self._chemin_job(job_id)) if job_id.isalnum() else None
+
+    def _evincer(self, age_jobs=86400):
+        if self.max_octets:
+            evincer_dossier(self.dossier, '.pdf', self.max_octets)
+        # États de rendu de plus d'un jour (un rendu resté "pending" vient d'un processus arrêté)
+        limite = time.time() - age_jobs
+        for date_modif, _, chemin in fichiers_dossier(os.path.join(self.dossier, 'jobs'), '.json'):
+            if date_modif < limite:
+                try:
+                    os.remove(chemin)
+                except FileNotFoundError:
+                    pass
+
+
+report_jobs = ReportJobs(app.config['REPORT_WORKERS'], app.config['REPORT_DIR'],
+                         app.config['REPORT_DIR_MB'] * 1024 * 1024)
+
+
+def _init_worker_rapport():
+    precharger_dependances(("rapport",))
+    # Processus forké : les connexions héritées du processus web ne doivent pas être partagées
+    with app.app_context():
+        for moteur in db.engines.values():
+            moteur.dispose(close=False)
+
+
+def _rendre_pdf(template, contexte, dossier, empreinte, forecast_rows=None, options=None, prevision=None,
+                transactions_de=None):
+    # Exécuté dans un worker ; renvoie l'empreinte du document, qui sert de nom de fichier
+    from xhtml2pdf import pisa
+
+    if transactions_de is not None:
+        # Export : les lignes sont lues ici, hors de la requête web, et leur contenu entre dans l'empreinte
+        with app.app_context():
+            txs = db.session.query(Transaction.date, Transaction.category, Transaction.amount) \
+                .filter(Transaction.user_id == transactions_de).order_by(Transaction.date)
+            contexte = dict(contexte, transactions=[t._asdict() for t in txs])
+        lignes = json.dumps(contexte["transactions"], default=str)
+        empreinte = hashlib.sha256(f"{empreinte}:{lignes}".encode()).hexdigest()
+
+    chemin = os.path.join(dossier, f"{empreinte}.pdf")
+    if os.path.exists(chemin):
+        # Document identique déjà rendu : ni prévision ni PDF à refaire
+        os.utime(chemin)
+        return empreinte
+
+    if forecast_rows is not None:
+        # Rapport : prévision, conseil et graphique sont calculés ici plutôt que dans la requête
+        if prevision is None:
+            prevision = _fit_forecast(forecast_rows, **options) if forecast_rows \
+                else {'historique': [], 'prevision': [], 'alerte': False}
+        contexte = dict(contexte,
+                        forecast=prevision['prevision'],
+                        conseil=generer_conseil(Totaux(*contexte['totaux']), prevision['prevision']),
+                        chart=rendre_graphique(prevision['historique'], prevision['prevision']))
+
+    with app.app_context():
+        html = render_template(template, **contexte)
+
+    # Écriture atomique : un document présent dans REPORT_DIR est toujours complet
+    temporaire = f"{chemin}.{os.getpid()}.tmp"
+    with open(temporaire, 'wb') as f:
+        with span('pisa.CreatePDF'):
+            pisa.CreatePDF(html, dest=f)
+    os.replace(temporaire, chemin)
+    return empreinte
+
+
+def reponse_rapport(job_id):
+    job = report_jobs.status(job_id)
+    if request.args.get('format') == 'json' or request.accept_mimetypes.best == 'application/json':
+        return jsonify(job), 200 if job["status"] == "done" else 202
+    if job["status"] == "done":
+        return redirect(url_for('telecharger_rapport', job_id=job_id))
+    return render_template('rapport_attente.html', job=job)
+
+
+@app.route('/rapports/<job_id>')
+@login_required
+def statut_rapport(job_id):
+    job = report_jobs.status(job_id)
+    if not job or job["user_id"] != current_user.id:
+        return jsonify({"error": "introuvable"}), 404
+    return jsonify(job)
+
+
+@app.route('/rapports/<job_id>/telecharger')
+@login_required
+def telecharger_rapport(job_id):
+    job = report_jobs.status(job_id)
+    chemin = report_jobs.chemin(job["empreinte"]) if job and job["status"] == "done" else None
+    if chemin is None or job["user_id"] != current_user.id or not os.path.exists(chemin):
+        flash("Document indisponible.")
+        return redirect('/transactions')
+    os.utime(chemin)  # dernier usage, pour l'éviction
+    return send_file(chemin, as_attachment=True, download_name=job["nom"], mimetype="application/pdf")
+
+
+# ------------------ GRAPHIQUES ------------------
+# API objet de matplotlib (Figure + canvas Agg) : aucun état global pyplot, utilisable depuis plusieurs threads
+def reduire_serie(points, max_points):
+    # Moyenne par paquets de k points consécutifs : l'échelle reste comparable à la prévision quotidienne
+    if len(points) <= max_points:
+        return [(p['day'], p['value']) for p in points]
+    k = -(-len(points) // max_points)
+    return [
+        (paquet[0]['day'], round(sum(p['value'] for p in paquet) / len(paquet), 2))
+        for paquet in (points[i:i + k] for i in range(0, len(points), k))
+    ]
+
+
+def rendre_graphique(historique, prevision, max_points=None):
+    historique = tuple(reduire_serie(historique, max_points or app.config['CHART_MAX_POINTS']))
+    prevision = tuple((p['day'], p['value']) for p in prevision)
+    return base64.b64encode(_png_graphique(historique, prevision)).decode('utf-8')
+
+
+@lru_cache(maxsize=app.config['CHART_CACHE_SIZE'])
+def _png_graphique(historique, prevision, max_labels=15):
+    # Mis en cache sur les séries elles-mêmes : mêmes données → même image, sans nouveau rendu
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(10, 4))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+
+    # Positions numériques : deux jours identiques (ex. 01/02 de deux années) restent distincts
+    labels = [jour for jour, _ in historique] + [jour for jour, _ in prevision]
+    n = len(historique)
+    ax.plot(range(n), [v for _, v in historique], label='Historique')
+    ax.plot(range(n, n + len(prevision)), [v for _, v in prevision], linestyle='--', label='Prévision')
+
+    pas = max(1, -(-len(labels) // max_labels))
+    ax.set_xticks(range(0, len(labels), pas))
+    ax.set_xticklabels(labels[::pas], rotation=45)
+    ax.legend()
+    fig.tight_layout()
+
+    buf = BytesIO()
+    with span('figure.savefig'):
+        fig.savefig(buf, format='png')
+    return buf.getvalue()
+
+
+# ------------------ DÉPENDANCES LOURDES ------------------
+# pandas, Prophet, matplotlib et xhtml2pdf sont importés à la première utilisation :
+# un worker démarre et sert /login sans les charger. Les familles de routes peuvent être préchargées.
+DEPENDANCES_LOURDES = {
+    "import": ("pandas",),
+    "forecast": ("numpy", "pandas", "prophet"),
+    "rapport": ("matplotlib.figure", "matplotlib.backends.backend_agg", "xhtml2pdf.pisa", "prophet"),
+    "export": ("pandas", "openpyxl", "xhtml2pdf.pisa"),
+}
+
+
+def precharger_dependances(groupes=None):
+    if isinstance(groupes, str):
+        groupes = [g.strip() for g in groupes.split(',') if g.strip()]
+    for groupe in groupes or DEPENDANCES_LOURDES:
+        for module in DEPENDANCES_LOURDES[groupe]:
+            if module.startswith('matplotlib'):
+                import matplotlib
+                matplotlib.use('Agg')
+            importlib.import_module(module)
+
+
+# ------------------ MIGRATIONS ------------------
+def creer_index():
+    # db.create_all() ne touche pas aux tables existantes : on ajoute les index manquants (SQLite et Postgres)
+    crees = []
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if not inspect(db.engine).has_index(table.name, index.name):
+                index.create(db.engine)
+                crees.append(index.name)
+    return crees
+
+
+def creer_colonnes():
+    # Idem pour les colonnes ajoutées à un modèle existant (ALTER TABLE ... ADD COLUMN)
+    crees = []
+    inspecteur = inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    with db.engine.begin() as connexion:
+        for table in db.metadata.sorted_tables:
+            if not inspecteur.has_table(table.name):
+                continue
+            existantes = {c['name'] for c in inspecteur.get_columns(table.name)}
+            for colonne in table.columns:
+                if colonne.name in existantes:
+                    continue
+                ddl = f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(colonne)} " \
+                      f"{colonne.type.compile(db.engine.dialect)}"
+                if colonne.server_default is not None:
+                    ddl += f" NOT NULL DEFAULT '{colonne.server_default.arg}'"
+                connexion.exec_driver_sql(ddl)
+                crees.append(f"{table.name}.{colonne.name}")
+    return crees
+
+
+@app.cli.command('creer-index')
+def creer_index_command():
+    colonnes = creer_colonnes()
+    if colonnes:
+        print(f"✅ Colonnes ajoutées : {', '.join(colonnes)}")
+    if "transaction.empreinte" in colonnes:
+        print(f"✅ Empreintes d'import calculées pour {remplir_empreintes()} transactions.")
+    crees = creer_index()
+    print(f"✅ Index créés : {', '.join(crees)}" if crees else "✅ Tous les index existent déjà.")
+
 
-    return alerts
 @app.template_filter('format_last_login')
 def format_last_login(date):
     if not date:
@@ -719,11 +2470,33 @@ def format_last_login(date):
     else:
         return date.strftime("Le %d/%m à %Hh%M")
 
+# Préchargement optionnel (gunicorn --preload, pools préchauffés)
+if app.config['PRELOAD_MODULES']:
+    precharger_dependances(app.config['PRELOAD_MODULES'])
+
 # ------------------ MAIN ------------------
 
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+        colonnes = creer_colonnes()
+        creer_index()
+
+        # Empreintes d'import pour les transactions antérieures au dédoublonnage
+        if "transaction.empreinte" in colonnes:
+            print(f"✅ Empreintes d'import calculées pour {remplir_empreintes()} transactions.")
+
+        # Remplir les agrégats pour une base existante
+        if not SoldeJournalier.query.first() and Transaction.query.first():
+            reconstruire_agregats()
+            print("✅ Agrégats journaliers et mensuels reconstruits.")
+
+        # Alertes stockées : première évaluation pour une base existante
+        if not Alerte.query.filter(Alerte.cle.isnot(None)).first() and Transaction.query.first():
+            for (uid,) in db.session.query(User.id):
+                evaluer_alertes(uid)
+            db.session.commit()
+            print("✅ Alertes évaluées.")
 
         # Créer un compte admin si aucun admin n'existe
         if not User.query.filter_by(is_admin=True).first():
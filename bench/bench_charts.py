@@ -0,0 +1,96 @@
+# ------------------ BENCHMARK GRAPHIQUES ------------------
+# Débit de rendu du graphique de rapport_pdf (graphiques/s) : ancien rendu pyplot sur la série brute,
+# rendu Figure/Agg sur la série réduite (cache vide), séries déjà en cache, et rendu concurrent en threads.
+#
+#   python bench/bench_charts.py --jours 730 --charts 50 --threads 4
+#
+# Le résultat est écrit en JSON sur la sortie standard.
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from io import BytesIO
+
+
+def serie(jours, graine):
+    rnd = random.Random(graine)
+    debut = date(2024, 1, 1)
+    historique = [
+        {"day": (debut + timedelta(days=i)).strftime('%d/%m'), "value": round(rnd.uniform(-800, 1200), 2),
+         "type": "historique"}
+        for i in range(jours)
+    ]
+    fin = debut + timedelta(days=jours)
+    prevision = [
+        {"day": (fin + timedelta(days=i)).strftime('%d/%m'), "value": round(rnd.uniform(-200, 400), 2),
+         "type": "prevision"}
+        for i in range(30)
+    ]
+    return historique, prevision
+
+
+def rendu_pyplot(historique, prevision):
+    # Rendu d'origine : état global pyplot, un point et une étiquette par jour
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    plt.figure(figsize=(10, 4))
+    plt.plot([h['day'] for h in historique], [h['value'] for h in historique], label='Historique')
+    plt.plot([p['day'] for p in prevision], [p['value'] for p in prevision], linestyle='--', label='Prévision')
+    plt.xticks(rotation=45)
+    plt.legend()
+    plt.tight_layout()
+    buf = BytesIO()
+    plt.savefig(buf, format='png')
+    plt.close()
+    return base64.b64encode(buf.getvalue()).decode('utf-8')
+
+
+def debit(fonction, series, threads=1):
+    debut = time.perf_counter()
+    if threads > 1:
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(lambda s: fonction(*s), series))
+    else:
+        for s in series:
+            fonction(*s)
+    duree = time.perf_counter() - debut
+    return {"graphiques": len(series), "duree_s": round(duree, 3), "graphiques_par_s": round(len(series) / duree, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jours', type=int, default=730, help="jours d'historique par série")
+    parser.add_argument('--charts', type=int, default=30, help="graphiques rendus par scénario")
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as m
+
+    uniques = [serie(args.jours, i) for i in range(args.charts)]
+    m.rendre_graphique(*serie(10, -1))  # import de matplotlib hors mesure
+
+    resultats = {"pyplot_brut": debit(rendu_pyplot, uniques)}
+    m._png_graphique.cache_clear()
+    resultats["figure_agg_reduit"] = debit(m.rendre_graphique, uniques)
+    resultats["cache"] = debit(m.rendre_graphique, uniques)
+    m._png_graphique.cache_clear()
+    resultats[f"figure_agg_{args.threads}_threads"] = debit(m.rendre_graphique, uniques, args.threads)
+
+    print(json.dumps({
+        "jours": args.jours,
+        "max_points": m.app.config['CHART_MAX_POINTS'],
+        "resultats": resultats,
+        "cache": m._png_graphique.cache_info()._asdict()
+    }, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# ------------------ BENCHMARK SIMULATION DE TRÉSORERIE ------------------
+# Temps de simuler_tresorerie (Monte Carlo, calculé dans la requête /forecast) selon le nombre de
+# trajectoires et la taille de l'historique rééchantillonné.
+#
+#   python bench/bench_simulation.py --chemins 10000 --jours 365 --categories 20
+#
+# Le résultat (p50/p95 en ms par configuration) est écrit en JSON sur la sortie standard.
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import date, timedelta
+
+
+def historique(jours, categories, par_jour, graine=0):
+    rnd = random.Random(graine)
+    noms = [f"Catégorie {i}" for i in range(categories)]
+    debut = date(2024, 1, 1)
+    lignes = [
+        (debut + timedelta(days=rnd.randrange(jours)), rnd.choice(noms), round(rnd.uniform(-900, 1000), 2))
+        for _ in range(jours * par_jour)
+    ]
+    return zip(*lignes), noms
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chemins', default='1000,10000,50000', help="trajectoires (liste séparée par des virgules)")
+    parser.add_argument('--jours', type=int, default=365, help="jours d'historique")
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--par-jour', type=int, default=5, help="couples (jour, catégorie) par jour")
+    parser.add_argument('--horizon', type=int, default=90)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as m
+
+    (jours, categories, montants), noms = historique(args.jours, args.categories, args.par_jour)
+    m.simuler_tresorerie(jours, categories, montants, 5000, chemins=100)  # import de NumPy hors mesure
+
+    resultats = {}
+    for chemins in (int(c) for c in args.chemins.split(',')):
+        for scenario, ajustements in (("base", None), ("reduction_20", {noms[0]: 0.8})):
+            durees = []
+            for graine in range(args.repeat):
+                debut = time.perf_counter()
+                sortie = m.simuler_tresorerie(jours, categories, montants, 5000, ajustements,
+                                              chemins=chemins, horizon=args.horizon, graine=graine)
+                durees.append((time.perf_counter() - debut) * 1000)
+            durees.sort()
+            resultats[f"{chemins}_{scenario}"] = {
+                "p50_ms": round(statistics.median(durees), 2),
+                "p95_ms": round(durees[int(0.95 * (len(durees) - 1))], 2),
+                "proba_decouvert": sortie["proba_decouvert"],
+            }
+
+    print(json.dumps({
+        "jours": args.jours,
+        "categories": args.categories,
+        "horizon": args.horizon,
+        "resultats": resultats
+    }, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
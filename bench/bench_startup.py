@@ -0,0 +1,134 @@
+# ------------------ BENCHMARK DÉMARRAGE ------------------
+# Temps d'import de app.py et mémoire (RSS) d'un worker neuf, puis coût du premier appel
+# de chaque famille de routes (chargement paresseux de pandas / Prophet / matplotlib / xhtml2pdf).
+#
+#   python bench/bench_startup.py --runs 5
+#   PRELOAD_MODULES=forecast,rapport python bench/bench_startup.py   # comparer avec un pool préchauffé
+#
+# Chaque mesure tourne dans un processus Python neuf ; le résultat est écrit en JSON sur la sortie standard.
+import argparse
+import io
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EMAIL, MOT_DE_PASSE = "bench@finai.com", "bench"
+
+FAMILLES = {
+    "login": ("GET", "/login"),
+    "transactions": ("GET", "/transactions"),
+    "forecast": ("GET", "/forecast"),
+    "rapport": ("GET", "/rapport"),
+    "export": ("GET", "/export/excel"),
+    "import": ("POST", "/import"),
+}
+MODULES_LOURDS = ("numpy", "pandas", "prophet", "matplotlib", "xhtml2pdf", "openpyxl")
+
+
+def rss_mb():
+    # Pic de mémoire résidente du processus (ru_maxrss est en Ko sous Linux)
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def seed():
+    import random
+    from datetime import date, timedelta
+    from werkzeug.security import generate_password_hash
+    import app as m
+
+    random.seed(0)
+    with m.app.app_context():
+        m.db.drop_all()
+        m.db.create_all()
+        user = m.User(email=EMAIL, password=generate_password_hash(MOT_DE_PASSE))
+        m.db.session.add(user)
+        m.db.session.commit()
+        m.db.session.add_all([
+            m.Transaction(user_id=user.id, date=date(2025, 1, 1) + timedelta(days=i // 2),
+                          category=random.choice(['Loyer', 'Vente', 'Frais']), amount=random.uniform(-500, 800))
+            for i in range(400)
+        ])
+        m.db.session.commit()
+        m.reconstruire_agregats()
+
+
+def mesure_enfant(famille):
+    debut = time.perf_counter()
+    import app as m
+    resultat = {"import_s": round(time.perf_counter() - debut, 3), "rss_import_mb": rss_mb()}
+
+    client = m.app.test_client()
+    if famille != "login":
+        client.post('/login', data={"email": EMAIL, "password": MOT_DE_PASSE})
+
+    methode, chemin = FAMILLES[famille]
+    debut = time.perf_counter()
+    if methode == "POST":
+        csv = b"date,category,amount\n2025-06-01,Vente,100\n2025-06-02,Frais,-40\n"
+        reponse = client.post(chemin, data={"file": (io.BytesIO(csv), "bench.csv")},
+                              content_type='multipart/form-data')
+    else:
+        reponse = client.get(chemin)
+    resultat.update({
+        "status": reponse.status_code,
+        "premiere_requete_ms": round((time.perf_counter() - debut) * 1000, 1),
+        "rss_apres_mb": rss_mb(),
+        "modules_charges": sorted(mod for mod in MODULES_LOURDS if mod in sys.modules),
+    })
+    print(json.dumps(resultat))
+
+
+def lancer(args, env):
+    sortie = subprocess.run([sys.executable, os.path.abspath(__file__)] + args, env=env, cwd=RACINE,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(sortie.strip().splitlines()[-1]) if sortie.strip() else None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=3, help="processus neufs par famille")
+    parser.add_argument('--familles', default=",".join(FAMILLES), help="familles de routes à mesurer")
+    parser.add_argument('--enfant', help=argparse.SUPPRESS)
+    parser.add_argument('--seed', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    sys.path.insert(0, RACINE)
+    if args.seed:
+        return seed()
+    if args.enfant:
+        return mesure_enfant(args.enfant)
+
+    with tempfile.TemporaryDirectory() as dossier:
+        # Calculs synchrones : la première requête inclut la prévision et le rendu PDF, pas seulement leur mise en file ;
+        # sans modèles Prophet persistés, chaque processus refait un vrai fit
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(dossier, 'bench.db')}",
+                   FORECAST_WORKERS="0", FORECAST_MODEL_DIR_MB="0",
+                   REPORT_WORKERS="0", REPORT_DIR=os.path.join(dossier, 'rapports'))
+        lancer(['--seed'], env)
+
+        resultats = {}
+        for famille in args.familles.split(','):
+            mesures = [lancer(['--enfant', famille], env) for _ in range(args.runs)]
+            resultats[famille] = {
+                cle: round(statistics.median(m[cle] for m in mesures), 3)
+                for cle in ("import_s", "rss_import_mb", "premiere_requete_ms", "rss_apres_mb")
+            }
+            resultats[famille]["status"] = mesures[-1]["status"]
+            resultats[famille]["modules_charges"] = mesures[-1]["modules_charges"]
+
+    print(json.dumps({
+        "python": sys.version.split()[0],
+        "preload": os.environ.get("PRELOAD_MODULES", ""),
+        "runs": args.runs,
+        "familles": resultats
+    }, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()